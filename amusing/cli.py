@@ -1,3 +1,4 @@
+import os
 from importlib import metadata
 from typing import Annotated, Optional
 
@@ -9,12 +10,29 @@ from amusing.cli_operations import (
     download_album_operation,
     download_library_operation,
     download_song_operation,
+    index_musicbrainz_operation,
     organize_library_operation,
     parse_library_operation,
+    review_matches_operation,
     show_similar_albums_in_db_operation,
     show_similar_songs_for_artist_in_db_operation,
     show_similar_songs_in_db_operation,
 )
+from amusing.core.artwork import DEFAULT_CACHE_SIZE_MB, configure_artwork_cache
+from amusing.core.match import DEFAULT_MATCH_THRESHOLD
+from amusing.core.musicbrainz_client import configure_musicbrainz_client
+from amusing.core.musicbrainz_index import INDEX_FILENAME, configure_musicbrainz_index
+from amusing.core.pipeline import (
+    DEFAULT_ARTWORK_WORKERS,
+    DEFAULT_DOWNLOAD_WORKERS,
+    DEFAULT_TAG_WORKERS,
+)
+from amusing.core.save_to_db import DEFAULT_BATCH_SIZE
+from amusing.core.ytmusic_client import (
+    DEFAULT_POOL_SIZE,
+    DEFAULT_REQUESTS_PER_SECOND,
+    configure_ytmusic_client,
+)
 from amusing.utils.config import APP_CONFIG
 
 app = typer.Typer(
@@ -35,18 +53,46 @@ def callback(
     _: bool = typer.Option(None, "--version", "-v", callback=version_callback)
 ) -> None:
     """My app description"""
+    configure_musicbrainz_client(
+        cache_dir=os.path.join(
+            APP_CONFIG["root_download_path"], "caches", ".musicbrainz"
+        )
+    )
+    configure_musicbrainz_index(
+        os.path.join(APP_CONFIG["root_download_path"], INDEX_FILENAME)
+    )
+    configure_ytmusic_client(
+        pool_size=APP_CONFIG.get("ytmusic_pool_size", DEFAULT_POOL_SIZE),
+        requests_per_second=APP_CONFIG.get(
+            "ytmusic_requests_per_second", DEFAULT_REQUESTS_PER_SECOND
+        ),
+    )
+    configure_artwork_cache(
+        cache_dir=os.path.join(APP_CONFIG["root_download_path"], "caches", ".artwork"),
+        max_size=APP_CONFIG.get("artwork_cache_size_mb", DEFAULT_CACHE_SIZE_MB)
+        * 1024
+        * 1024,
+    )
 
 
 @app.command("album")
 def download_album(
     title: str = typer.Option(..., help="Title of the album"),
     artist: Optional[str] = typer.Option(None, help="Artist of the album (optional)"),
+    enrich: Annotated[
+        bool,
+        typer.Option(
+            help="Also fetch the composers and genres of the songs from MusicBrainz."
+        ),
+    ] = False,
 ):
     """Search and download the album and add it and any or all of its songs to the db.
     Creates a new album if not already present.
     This is the preferred way of adding new songs/albums to the music library.
     """
-    output = download_album_operation(title, APP_CONFIG["root_download_path"], artist)
+    output = download_album_operation(
+        title, APP_CONFIG["root_download_path"], artist, enrich
+    )
     print(output)
 
 
@@ -73,10 +119,58 @@ def parse_library(
         typer.Argument(
             help="The path to the 'Library.xml' or 'Library.csv' exported from Apple Music."
         ),
-    ]
+    ],
+    full: Annotated[
+        bool,
+        typer.Option(
+            help="Process every track, not only the ones changed since the last parse."
+        ),
+    ] = False,
+    csv: Annotated[
+        bool,
+        typer.Option(
+            help="Export the parsed library to 'Library.csv'. With --no-csv, a 'Library.xml' is streamed straight into the DB and an existing 'Library.csv' is only kept up to date."
+        ),
+    ] = True,
+    batch_size: Annotated[
+        int, typer.Option(help="Number of rows written to the DB per transaction.")
+    ] = DEFAULT_BATCH_SIZE,
+    resume: Annotated[
+        bool,
+        typer.Option(
+            help="Reuse the video IDs resolved by a previously interrupted run."
+        ),
+    ] = True,
+    chunk_size: Annotated[
+        int,
+        typer.Option(
+            help="Process the 'Library.csv' this many rows at a time to bound memory use, 0 to read it whole."
+        ),
+    ] = 0,
+    auto_match: Annotated[
+        bool,
+        typer.Option(
+            help="Choose YouTube Music results without asking when they match well enough, the other songs are queued for 'amusing review'."
+        ),
+    ] = False,
+    match_threshold: Annotated[
+        float,
+        typer.Option(
+            help="Score between 0 and 1 from which a result is chosen with --auto-match."
+        ),
+    ] = DEFAULT_MATCH_THRESHOLD,
 ):
     """Parse the entire Apple Music library and make/update the DB as needed."""
-    output = parse_library_operation(APP_CONFIG["root_download_path"], library_path)
+    output = parse_library_operation(
+        APP_CONFIG["root_download_path"],
+        library_path,
+        full,
+        csv,
+        batch_size,
+        resume,
+        chunk_size,
+        match_threshold if auto_match else None,
+    )
     if output:
         print(output)
 
@@ -88,16 +182,98 @@ def download_library(
         typer.Argument(
             help="The path to the 'Library.xml' or 'Library.csv' exported from Apple Music."
         ),
-    ] = ""
+    ] = "",
+    full: Annotated[
+        bool,
+        typer.Option(
+            help="Process every track, not only the ones changed since the last parse."
+        ),
+    ] = False,
+    csv: Annotated[
+        bool,
+        typer.Option(
+            help="Export the parsed library to 'Library.csv'. With --no-csv, a 'Library.xml' is streamed straight into the DB and an existing 'Library.csv' is only kept up to date."
+        ),
+    ] = True,
+    batch_size: Annotated[
+        int, typer.Option(help="Number of rows written to the DB per transaction.")
+    ] = DEFAULT_BATCH_SIZE,
+    resume: Annotated[
+        bool,
+        typer.Option(
+            help="Reuse the video IDs resolved by a previously interrupted run."
+        ),
+    ] = True,
+    chunk_size: Annotated[
+        int,
+        typer.Option(
+            help="Process the 'Library.csv' this many rows at a time to bound memory use, 0 to read it whole."
+        ),
+    ] = 0,
+    auto_match: Annotated[
+        bool,
+        typer.Option(
+            help="Choose YouTube Music results without asking when they match well enough, the other songs are queued for 'amusing review'."
+        ),
+    ] = False,
+    match_threshold: Annotated[
+        float,
+        typer.Option(
+            help="Score between 0 and 1 from which a result is chosen with --auto-match."
+        ),
+    ] = DEFAULT_MATCH_THRESHOLD,
+    download_workers: Annotated[
+        int, typer.Option(help="Number of songs downloaded from YouTube at once.")
+    ] = DEFAULT_DOWNLOAD_WORKERS,
+    artwork_workers: Annotated[
+        int, typer.Option(help="Number of album artworks downloaded at once.")
+    ] = DEFAULT_ARTWORK_WORKERS,
+    tag_workers: Annotated[
+        int, typer.Option(help="Number of song files generated at once.")
+    ] = DEFAULT_TAG_WORKERS,
 ):
     """Download the entire DB library.
 
     If passed, parse the library and update the DB before download.
     """
     if library_path:
-        parse_library_operation(APP_CONFIG["root_download_path"], library_path)
+        parse_library_operation(
+            APP_CONFIG["root_download_path"],
+            library_path,
+            full,
+            csv,
+            batch_size,
+            resume,
+            chunk_size,
+            match_threshold if auto_match else None,
+        )
+
+    output = download_library_operation(
+        APP_CONFIG["root_download_path"], download_workers, artwork_workers, tag_workers
+    )
+    if output:
+        print(output)
+
 
-    output = download_library_operation(APP_CONFIG["root_download_path"])
+@app.command("review")
+def review_matches():
+    """Choose the YouTube Music results of the songs left unmatched by --auto-match."""
+    output = review_matches_operation(APP_CONFIG["root_download_path"])
+    if output:
+        print(output)
+
+
+@app.command("index")
+def index_musicbrainz(
+    dump_path: Annotated[
+        str,
+        typer.Argument(
+            help="The path to a MusicBrainz JSON dump of releases (release.tar.xz), or a file of one release JSON per line."
+        ),
+    ]
+):
+    """Build a local MusicBrainz index, searched by the song and album commands before MusicBrainz."""
+    output = index_musicbrainz_operation(APP_CONFIG["root_download_path"], dump_path)
     if output:
         print(output)
 
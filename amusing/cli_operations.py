@@ -1,18 +1,33 @@
 import hashlib
+import json
 import os
+import sqlite3
 from shutil import copyfile
 
 import typer
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 
 from amusing.core.download import download
+from amusing.core.ingest import ingest_library_xml
 from amusing.core.metadata import search_album_metadata, search_songs_metadata
+from amusing.core.musicbrainz_client import MusicBrainzError
+from amusing.core.musicbrainz_index import INDEX_FILENAME, build_index
 from amusing.core.parse_csv import process_csv
-from amusing.core.parse_xml import parse_library_xml
-from amusing.core.save_to_db import check_if_song_in_db
-from amusing.core.search import search
+from amusing.core.parse_xml import MANIFEST_FILENAME, parse_library_xml, save_manifest
+from amusing.core.pipeline import (
+    DEFAULT_ARTWORK_WORKERS,
+    DEFAULT_DOWNLOAD_WORKERS,
+    DEFAULT_TAG_WORKERS,
+    DownloadPipeline,
+)
+from amusing.core.save_to_db import (
+    DEFAULT_BATCH_SIZE,
+    check_if_song_in_db,
+    load_song_files,
+)
+from amusing.core.search import choose_result, search
 from amusing.db.engine import get_new_db_session
-from amusing.db.models import Album, Organizer, Song
+from amusing.db.models import Album, Organizer, ReviewItem, Song, SongFile
 from amusing.utils.funcs import construct_db_path, short_filename, short_filename_clean
 
 
@@ -33,7 +48,11 @@ def download_song_operation(
     overwrite (bool): whether to overwrite the song if present in db and downloads.
 
     """
-    song_metadata_dict = search_songs_metadata(song_name, artist_name, album_name)
+    try:
+        song_metadata_dict = search_songs_metadata(song_name, artist_name, album_name)
+    except MusicBrainzError as e:
+        print(f"[!] Error: {e}")
+        return "Couldn't fetch the song metadata from MusicBrainz. Please try again."
     if song_metadata_dict:
         song = Song(
             title=song_metadata_dict["title"],
@@ -49,8 +68,11 @@ def download_song_operation(
             artist=artist_name,
             album=Album(title=album_name),
         )
+    session = get_new_db_session(construct_db_path(root_download_path))
     # fetch song from YT Music
-    song_fetched = search(song)
+    song_fetched = search(song, session)
+    # keep the search results cached even if the download fails
+    session.commit()
     if not song_fetched:
         return "Couldn't find song through YouTube Music Search."
     try:
@@ -63,7 +85,6 @@ def download_song_operation(
         return "Is FFmpeg installed? It is required to generate the songs."
 
     # insert into db
-    session = get_new_db_session(construct_db_path(root_download_path))
     albums = (
         session.query(Album).filter(Album.title.ilike(f"%{song.album.title}%")).all()
     )
@@ -133,7 +154,8 @@ def _download_all_songs_for_given_album(
         song.track = song_metadata_dict.get("track_number")
         song.genre = song_metadata_dict.get("genre")
         # fetch song from YT Music
-        song_fetched = search(song)
+        song_fetched = search(song, session)
+        session.commit()
         if not song_fetched:
             return "Couldn't find song through YouTube Music Search."
         try:
@@ -141,7 +163,8 @@ def _download_all_songs_for_given_album(
             song_fetched.title = song_metadata_dict["title"]
             song_fetched.artist = song_metadata_dict["artist"]
             song_fetched.album = album
-            download(song_fetched, root_download_path, True)
+            # a song file already present is only updated if its tags changed
+            download(song_fetched, root_download_path)
         except RuntimeError as e:
             print(f"[!] Error: {e}")
             return "Something went wrong while downloading a song."
@@ -165,6 +188,7 @@ def download_album_operation(
     album_name: str,
     root_download_path: str,
     artist_name: str = None,
+    enrich: bool = False,
 ):
     """Download a particular album and all of its songs and add it to the db.
 
@@ -172,8 +196,13 @@ def download_album_operation(
     album_name (str): name of the album
     artist_name (str): name of the artist
     root_download_path (str): the path to download songs and put db into.
+    enrich (bool): whether to also fetch the composers and genres of the songs.
     """
-    album_metadata = search_album_metadata(album_name, artist_name)
+    try:
+        album_metadata = search_album_metadata(album_name, artist_name, enrich)
+    except MusicBrainzError as e:
+        print(f"[!] Error: {e}")
+        return "Couldn't fetch the album metadata from MusicBrainz. Please try again."
 
     # add new album to db or edit an existing album
     session = get_new_db_session(construct_db_path(root_download_path))
@@ -234,15 +263,50 @@ def download_album_operation(
     )
 
 
-def parse_library_operation(root_download_path: str, lib_path: str) -> str:
+def parse_library_operation(
+    root_download_path: str,
+    lib_path: str,
+    full: bool = False,
+    csv: bool = True,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    resume: bool = True,
+    chunk_size: int = 0,
+    threshold: float = None,
+) -> str:
     """Parse the Library XML or CSV file.
 
     Parameters:
     lib_path (str): the full path to the Library.xml file exported from Apple Music or a Library.csv file
+    full (bool): whether to process every track of the Library.xml instead of only the ones changed since the last parse.
+    csv (bool): whether to export the Library.xml to a Library.csv, otherwise its tracks are streamed straight into the db.
+    batch_size (int): the number of rows written to the db per transaction.
+    resume (bool): whether to reuse the video IDs resolved by an interrupted run.
+    chunk_size (int): the number of rows of the Library.csv held in memory at once, 0 to read it whole.
+    threshold (float): the score from which a YouTube Music result is chosen without asking, None to always ask.
 
     """
+    delta = None
+    manifest = None
     if lib_path.lower().endswith(".xml"):
-        error = parse_library_xml(root_download_path, lib_path)
+        if not csv:
+            session = get_new_db_session(construct_db_path(root_download_path))
+            error = ingest_library_xml(
+                root_download_path,
+                lib_path,
+                session,
+                incremental=not full,
+                batch_size=batch_size,
+                resume=resume,
+                threshold=threshold,
+            )
+            if error:
+                return (
+                    "Something went wrong in ingesting the XML file. Please try again."
+                )
+            return ""
+        delta, manifest, error = parse_library_xml(
+            root_download_path, lib_path, incremental=not full
+        )
         if error:
             return "Something went wrong in creating a parsed CSV file from XML. Please try again."
         parsed_library = os.path.join(root_download_path, "Library.csv")
@@ -252,34 +316,106 @@ def parse_library_operation(root_download_path: str, lib_path: str) -> str:
         return "A 'Library.xml' or 'Library.csv' file was expected."
 
     session = get_new_db_session(construct_db_path(root_download_path))
-    process_csv(parsed_library, session)
+    process_csv(
+        parsed_library, session, delta, batch_size, resume, chunk_size, threshold
+    )
+    if manifest is not None:
+        # Saved last, so that an interrupted run is parsed again from the same delta
+        save_manifest(os.path.join(root_download_path, MANIFEST_FILENAME), manifest)
 
     return ""
 
 
-def download_library_operation(root_download_path: str) -> str:
+def download_library_operation(
+    root_download_path: str,
+    download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    artwork_workers: int = DEFAULT_ARTWORK_WORKERS,
+    tag_workers: int = DEFAULT_TAG_WORKERS,
+) -> str:
     """Download all songs in DB.
 
     Parameters:
     root_download_path (str): songs download path.
+    download_workers (int): the number of songs downloaded from YouTube at once.
+    artwork_workers (int): the number of album artworks downloaded at once.
+    tag_workers (int): the number of song files generated at once.
 
     """
     session = get_new_db_session(construct_db_path(root_download_path))
     albums = session.query(Album).order_by(Album.title)
-    for album in albums:
-        for song in album.songs:
-            try:
-                download(song, root_download_path)
-            except RuntimeError as e:
-                print(f"[!] Error: {e}")
-                print("[!] Something went wrong while downloading. Skipping song.")
-            except FileNotFoundError as e:
-                print(f"[!] Error: {e}")
-                return "Is FFmpeg installed? It is required to generate the songs."
+    pipeline = DownloadPipeline(
+        root_download_path,
+        download_workers=download_workers,
+        artwork_workers=artwork_workers,
+        tag_workers=tag_workers,
+        session=session,
+        song_files=load_song_files(session),
+    )
+    error = pipeline.run(song for album in albums for song in album.songs)
+    if isinstance(error, FileNotFoundError):
+        print(f"[!] Error: {error}")
+        return "Is FFmpeg installed? It is required to generate the songs."
 
     return ""
 
 
+def review_matches_operation(root_download_path: str) -> str:
+    """Choose the YouTube Music results of the songs queued for review by an auto-matched parse.
+
+    The chosen video IDs are used by the next parse of the library.
+
+    Parameters:
+    root_download_path (str): the path to the root downloads folder where the db is situated.
+
+    """
+    session = get_new_db_session(construct_db_path(root_download_path))
+    items = (
+        session.query(ReviewItem)
+        .filter(ReviewItem.video_id.is_(None))
+        .order_by(ReviewItem.album, ReviewItem.title)
+        .all()
+    )
+    if not items:
+        return "No songs to review."
+    reviewed = 0
+    for item in items:
+        print("---")
+        typer.echo(
+            f"Reviewing song: '{item.title} - {item.album} - {item.artist}' (best score {item.score:.2f})"
+        )
+        candidates = json.loads(item.candidates)
+        for candidate in candidates:
+            candidate["title"] = f"{candidate.get('title')} ({candidate['score']:.2f})"
+        song_result = choose_result(candidates, skip=True)
+        if song_result is None:
+            continue
+        item.video_id = song_result["videoId"]
+        session.commit()
+        reviewed += 1
+
+    return f"Reviewed {reviewed} songs, parse the library again to add them to the db."
+
+
+def index_musicbrainz_operation(root_download_path: str, dump_path: str) -> str:
+    """Build the local MusicBrainz index searched before MusicBrainz itself.
+
+    Parameters:
+    root_download_path (str): the path to the root downloads folder where the index is situated.
+    dump_path (str): the path to a MusicBrainz JSON dump of releases, or to a file of one release JSON per line.
+
+    """
+    if not os.path.exists(dump_path):
+        return f"The MusicBrainz dump '{dump_path}' was not found."
+    try:
+        count = build_index(dump_path, os.path.join(root_download_path, INDEX_FILENAME))
+    except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+        print(f"[!] Error: {e}")
+        return (
+            "Something went wrong in building the MusicBrainz index. Please try again."
+        )
+    return f"Indexed {count} releases."
+
+
 def organize_library_operation(root_download_path: str, destination_path: str) -> str:
     """Organize the downloaded music library for an application like Plex or Jellyfin.
 
@@ -301,21 +437,32 @@ def organize_library_operation(root_download_path: str, destination_path: str) -
     destination_path (str): the full destination path in which to copy and organize the music library
     """
     session = get_new_db_session(construct_db_path(root_download_path))
-    for song, organizer in (
-        session.query(Song, Organizer)
+    # Songs, their albums and files come from the db in one query
+    for song, organizer, song_file in (
+        session.query(Song, Organizer, SongFile)
+        .options(joinedload(Song.album))
         .outerjoin(Organizer, Song.id == Organizer.song_id)
+        .outerjoin(SongFile, Song.id == SongFile.song_id)
         .all()
     ):
-        songs_dir = os.path.join(root_download_path, "songs")
-        song_name = f"{song.title} - {song.album.title} - {song.artist}"
-        artwork_url = song.album.artwork_url
-        if artwork_url is None:
-            artwork_url = ""
-        artwork_hash = hashlib.md5(artwork_url.encode()).hexdigest()
-        song_filename = short_filename(
-            songs_dir, song_name, artwork_hash, song.video_id
-        )
-        song_file_path = os.path.join(songs_dir, song_filename)
+        if song_file is not None and song_file.video_id == song.video_id:
+            song_file_path = song_file.path
+        else:
+            # Song downloaded before the files inventory, or whose file is not
+            # generated from its current video yet
+            songs_dir = os.path.join(root_download_path, "songs")
+            song_name = f"{song.title} - {song.album.title} - {song.artist}"
+            artwork_url = song.album.artwork_url
+            if artwork_url is None:
+                artwork_url = ""
+            artwork_hash = hashlib.md5(artwork_url.encode()).hexdigest()
+            song_filename = short_filename(
+                songs_dir, song_name, artwork_hash, song.video_id
+            )
+            song_file_path = os.path.join(songs_dir, song_filename)
+            if not os.path.exists(song_file_path):
+                print(f"[!] Song file not downloaded yet, skipping: {song_file_path}")
+                continue
         clean_song_filename = short_filename_clean(song.title)
         destination_dir = os.path.join(destination_path, song.artist, song.album.title)
         os.makedirs(destination_dir, exist_ok=True)
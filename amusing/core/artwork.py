@@ -0,0 +1,199 @@
+import hashlib
+import os
+import subprocess
+import threading
+from collections import OrderedDict
+
+import requests
+
+from amusing.core.http import Shared, new_session
+
+# Side of the square album artwork embedded in the song files
+ARTWORK_SIZE = 600
+ARTWORK_FILTER = (
+    "crop=w='min(iw\\,ih)':h='min(iw\\,ih)',"
+    f"scale={ARTWORK_SIZE}:{ARTWORK_SIZE},setsar=1"
+)
+# Total size in megabytes of the converted artworks kept in the cache
+DEFAULT_CACHE_SIZE_MB = 200
+# Number of connections kept alive to download artworks
+DEFAULT_POOL_SIZE = 4
+DEFAULT_TIMEOUT = 30
+
+
+def artwork_key(artwork_url: str) -> str:
+    """Return the hash of an artwork URL, used in file names."""
+    return hashlib.md5((artwork_url or "").encode()).hexdigest()
+
+
+def normalize_artwork(image: bytes) -> bytes:
+    """
+    Crop an image to a square and scale it to the embedded artwork size, as PNG.
+    Requires FFmpeg installed, only the image goes through it.
+    """
+    result = subprocess.run(
+        [
+            "ffmpeg",
+            "-i",
+            "pipe:0",
+            "-vf",
+            ARTWORK_FILTER,
+            "-frames:v",
+            "1",
+            "-vcodec",
+            "png",
+            "-f",
+            "image2pipe",
+            "pipe:1",
+        ],
+        input=image,
+        capture_output=True,
+    )
+    if result.returncode or not result.stdout:
+        print(result.stderr.decode(errors="replace"))
+        raise RuntimeError(
+            f"FFmpeg failed to convert the artwork, exited with error code {result.returncode}"
+        )
+    return result.stdout
+
+
+class ArtworkCache:
+    """
+    Album artworks downloaded and converted once to the embedded size, shared
+    by all the songs of the albums with the same artwork URL.
+
+    Artworks are downloaded through a pooled HTTP session. Converted artworks
+    are kept in cache_dir, keyed by the hash of their URL, up to max_size bytes:
+    the least recently used are evicted first. Without cache_dir, artworks are
+    downloaded and converted each time.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = None,
+        max_size: int = DEFAULT_CACHE_SIZE_MB * 1024 * 1024,
+        pool_size: int = DEFAULT_POOL_SIZE,
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.session = new_session(pool_size)
+        self.lock = threading.Lock()
+        # Lock of each artwork being converted, so that it is converted once
+        self.key_locks = {}
+        # Size of the cached artworks, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.scan()
+
+    def scan(self):
+        with os.scandir(self.cache_dir) as entries:
+            files = [
+                (entry.stat().st_mtime, entry.name, entry.stat().st_size)
+                for entry in entries
+                if entry.is_file() and entry.name.endswith(".png")
+            ]
+        for _, name, size in sorted(files):
+            self.entries[name[: -len(".png")]] = size
+            self.size += size
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def touch(self, key: str) -> bool:
+        """Mark a cached artwork as used, returns whether it is cached."""
+        with self.lock:
+            if key not in self.entries:
+                return False
+            try:
+                # The modification time orders the cache across runs
+                os.utime(self.path(key))
+            except FileNotFoundError:
+                self.size -= self.entries.pop(key)
+                return False
+            self.entries.move_to_end(key)
+            return True
+
+    def add(self, key: str, image: bytes):
+        """Cache a converted artwork and evict the least recently used ones over max_size."""
+        path = self.path(key)
+        temp_path = f"{path}.part"
+        with open(temp_path, "wb") as file:
+            file.write(image)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.size += len(image) - self.entries.pop(key, 0)
+            self.entries[key] = len(image)
+            while self.size > self.max_size and len(self.entries) > 1:
+                evicted, size = self.entries.popitem(last=False)
+                self.size -= size
+                try:
+                    os.remove(self.path(evicted))
+                except FileNotFoundError:
+                    pass
+
+    def download(self, artwork_url: str) -> bytes:
+        """
+        Download an artwork and convert it.
+
+        Raises: RuntimeError if it cannot be downloaded
+        """
+        print(f"[+] Downloading album artwork from: {artwork_url}")
+        try:
+            response = self.session.get(artwork_url, timeout=DEFAULT_TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException:
+            raise RuntimeError(f"failed to download album artwork at: {artwork_url}")
+        return normalize_artwork(response.content)
+
+    def prepare(self, artwork_url: str) -> str:
+        """
+        Download and convert an artwork, unless already cached.
+
+        Returns: the path of the converted artwork, "" without cache_dir
+        """
+        if not self.cache_dir:
+            return ""
+        key = artwork_key(artwork_url)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                if not self.touch(key):
+                    self.add(key, self.download(artwork_url))
+        finally:
+            # Once cached, the artwork is only touched, no lock is kept for it
+            with self.lock:
+                if self.key_locks.get(key) is key_lock:
+                    del self.key_locks[key]
+        return self.path(key)
+
+    def artwork(self, artwork_url: str) -> bytes:
+        """Return a converted artwork, from the cache if possible."""
+        if not self.cache_dir:
+            return self.download(artwork_url)
+        while True:
+            path = self.prepare(artwork_url)
+            try:
+                with open(path, "rb") as file:
+                    return file.read()
+            except FileNotFoundError:
+                # Evicted in the meantime
+                continue
+
+
+_cache = Shared(ArtworkCache)
+
+
+def configure_artwork_cache(**settings):
+    """
+    Set the cache_dir, max_size or pool_size of the shared artwork cache,
+    before it is first used.
+    """
+    _cache.configure(**settings)
+
+
+def get_artwork_cache() -> ArtworkCache:
+    """Return the artwork cache shared by the whole process."""
+    return _cache.get()
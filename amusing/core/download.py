@@ -1,121 +1,223 @@
-import hashlib
 import os
 import re
-import shutil
-import subprocess
-import urllib.request
+import threading
+from glob import escape as glob_escape
 from glob import glob
 
 import yt_dlp
 
-from amusing.db.models import Song
+from amusing.core.artwork import artwork_key, get_artwork_cache, normalize_artwork
+from amusing.core.tagging import (
+    read_fingerprint,
+    retag_song_file,
+    tag_fingerprint,
+    tag_song_file,
+)
+from amusing.db.models import Song, SongFile
 from amusing.utils.funcs import escape, short_filename
 
+YDL_OPTIONS = {
+    "format": "m4a/bestaudio/best",
+    # ℹ️ See help(yt_dlp.postprocessor) for a list of available Postprocessors and their arguments
+    "postprocessors": [
+        {  # Extract audio using ffmpeg, only if not already m4a
+            "key": "FFmpegExtractAudio",
+            "preferredcodec": "m4a",
+        }
+    ],
+    "outtmpl": {"pl_thumbnail": ""},
+    # The video thumbnail is written only when needed as artwork, next to the
+    # downloaded audio, and embedded along with the tags each time a song file
+    # is generated from it
+    "writethumbnail": False,
+}
+# Extensions of the video thumbnails written next to the downloaded songs
+THUMBNAIL_EXTENSIONS = ["webp", "jpg", "png"]
 
-def download_song_from_video_id(video_id: str, path: str):
+
+class SongDownloader:
+    """
+    A long-lived YouTube downloader, serving many video IDs with the same
+    extractors, HTTP session and cookie jar.
+
+    A YoutubeDL instance is not thread-safe, each thread uses its own
+    downloader, see get_song_downloader.
+    """
+
+    def __init__(self, options: dict = None):
+        self.ydl = yt_dlp.YoutubeDL({**YDL_OPTIONS, **(options or {})})
+
+    def download(
+        self,
+        url: str,
+        path: str,
+        ie_key: str = None,
+        thumbnail: bool = False,
+        audio: bool = True,
+    ) -> tuple:
+        """
+        Download a video into path, with its thumbnail if asked, or only its
+        thumbnail without audio.
+
+        Returns: the paths of the downloaded file and thumbnail, "" if unknown
+        """
+        self.ydl.params["paths"] = {"home": path}
+        self.ydl.params["writethumbnail"] = thumbnail or not audio
+        self.ydl.params["skip_download"] = not audio
+        # Unlike download(), raises on error instead of returning an error code
+        # that sticks for the following downloads
+        info = self.ydl.extract_info(url, download=True, ie_key=ie_key) or {}
+        downloads = info.get("requested_downloads") or [{}]
+        thumbnails = [
+            image["filepath"]
+            for image in info.get("thumbnails") or []
+            if image.get("filepath")
+        ]
+        return downloads[0].get("filepath", ""), next(iter(thumbnails), "")
+
+    def close(self):
+        self.ydl.close()
+
+
+_downloaders = threading.local()
+
+
+def get_song_downloader() -> SongDownloader:
+    """Return the song downloader of the current thread."""
+    if not hasattr(_downloaders, "downloader"):
+        _downloaders.downloader = SongDownloader()
+    return _downloaders.downloader
+
+
+def close_song_downloader():
+    """Close the song downloader of the current thread, if it has one."""
+    downloader = getattr(_downloaders, "downloader", None)
+    if downloader is not None:
+        del _downloaders.downloader
+        downloader.close()
+
+
+def download_song_from_video_id(video_id: str, path: str, thumbnail: bool = False):
     """
-    Download a song into path through its video_id from YouTube.
+    Download a song into path through its video_id from YouTube, with the video
+    thumbnail if asked.
 
-    Returns: the downloaded song filename
+    Returns: the downloaded song file and thumbnail paths, "" if unknown
     """
     song_url = f"https://www.youtube.com/watch?v={video_id}"
-    ydl_opts = {
-        "format": "m4a/bestaudio/best",
-        # ℹ️ See help(yt_dlp.postprocessor) for a list of available Postprocessors and their arguments
-        "postprocessors": [
-            {  # Extract audio using ffmpeg
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "m4a",
-            }
-        ],
-        "paths": {"home": path},
-        "outtmpl": {"pl_thumbnail": ""},
-        "postprocessors": [{"already_have_thumbnail": False, "key": "EmbedThumbnail"}],
-        "writethumbnail": True,
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        try:
-            error_code = ydl.download(song_url)
-            if error_code:
-                raise RuntimeError(
-                    f"video [{video_id}] download failed with error code: {error_code}"
-                )
-        except Exception:
-            raise RuntimeError(f"video [{video_id}] download failed")
+    try:
+        return get_song_downloader().download(song_url, path, thumbnail=thumbnail)
+    except Exception:
+        raise RuntimeError(f"video [{video_id}] download failed")
+
+
+def download_thumbnail_from_video_id(video_id: str, path: str) -> str:
+    """
+    Download the thumbnail of a video into path, next to its audio.
+
+    Returns: the thumbnail path, "" if it cannot be downloaded
+    """
+    song_url = f"https://www.youtube.com/watch?v={video_id}"
+    try:
+        return get_song_downloader().download(song_url, path, audio=False)[1]
+    except Exception:
+        print(f"[!] Could not download the thumbnail of video [{video_id}]")
+        return ""
+
+
+def artwork_hash(album) -> str:
+    """Return the hash of the artwork URL of an album, used in file names."""
+    return artwork_key(album.artwork_url)
+
+
+def prepare_album_artwork(artwork_url: str) -> str:
+    """
+    Download and convert the custom artwork of albums once for all their songs.
+
+    Returns: the converted artwork path, "" if not cached
+    """
+    return get_artwork_cache().prepare(artwork_url)
+
+
+def album_artwork(song: Song, thumbnail_path: str = "") -> bytes:
+    """
+    Return the converted custom artwork of the album of a song, else its video
+    thumbnail converted, None if neither.
+    """
+    artwork_url = song.album.artwork_url
+    if artwork_url:
+        return get_artwork_cache().artwork(artwork_url)
+    if thumbnail_path:
+        with open(thumbnail_path, "rb") as thumbnail_file:
+            return normalize_artwork(thumbnail_file.read())
+    return None
 
 
 def add_metadata(
     input_file: str,
     output_file: str,
-    album_dir: str,
     song: Song,
+    fingerprint: str = None,
+    thumbnail_path: str = "",
 ):
-    """Adds metadata to the song file. Requires FFmpeg installed."""
-    album = song.album
-    artwork_url = album.artwork_url
-    if artwork_url is None:
-        artwork_url = ""
-    artwork_hash = hashlib.md5(artwork_url.encode()).hexdigest()
-    artwork_path = os.path.join(album_dir, f"artwork [{artwork_hash}].png")
-    custom_artwork = artwork_url != ""
-    if custom_artwork and not os.path.exists(artwork_path):
-        artwork_file = open(artwork_path, "wb")
-        try:
-            print(f"[+] Downloading album artwork from: {artwork_url}")
-            response = urllib.request.urlopen(artwork_url)
-            shutil.copyfileobj(response, artwork_file)
-        except Exception as e:
-            os.remove(artwork_path)
-            raise RuntimeError(f"failed to download album artwork at: {artwork_url}")
-
-    args = [
-        "ffmpeg",
-        "-y",
-        "-i",
-        input_file,
-        "-metadata",
-        f"title={song.title}",
-        "-metadata",
-        f"album={album.title}",
-        "-metadata",
-        f"artist={song.artist}",
-        "-metadata",
-        f"composer={song.composer}",
-        "-metadata",
-        f"genre={song.genre}",
-        "-metadata",
-        f"disc={song.disc}",
-        "-metadata",
-        f"track={song.track}/{album.tracks}",
-        "-metadata",
-        f"album_artist={album.artist}",
-        "-metadata",
-        f"date={album.release_date}",
-        "-acodec",
-        "copy",
-        "-vcodec",
-        "png",
-        "-disposition:v",
-        "attached_pic",
-        "-vf",
-        "crop=w='min(iw\,ih)':h='min(iw\,ih)',scale=600:600,setsar=1",
-        output_file,
-    ]
+    """Adds metadata to the song file. Requires FFmpeg installed for the artwork."""
+    artwork = album_artwork(song, thumbnail_path)
+    tag_song_file(input_file, output_file, song, artwork, fingerprint)
+
+
+class DirectoryIndex:
+    """
+    Index the files of directories by a key read from their names, e.g. the
+    video ID of the songs downloaded in an album cache directory.
+
+    A directory is scanned once, on its first lookup, then files are added as
+    they are created, so that lookups do not list the directory again.
+    """
 
-    if custom_artwork:
-        # Add artwork input to arguments
-        args.insert(4, "-i")
-        args.insert(5, artwork_path)
+    def __init__(self, pattern: str):
+        # The key is the first group of the pattern
+        self.regex = re.compile(pattern)
+        self.directories = {}
+        self.lock = threading.Lock()
 
-    result = subprocess.run(
-        args,
-        capture_output=True,
-        text=True,
-    )
-    rc = result.returncode
-    if rc:
-        print(result.stderr)
-        print(f"[!] FFmpeg exited with error code {rc}")
+    def scan(self, directory: str) -> dict:
+        files = {}
+        if os.path.isdir(directory):
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    match = self.regex.match(entry.name)
+                    if match and entry.is_file():
+                        files[match.group(1)] = entry.path
+        return files
+
+    def get(self, directory: str, key: str) -> str:
+        """Return the path of the file with the given key in directory, "" if none."""
+        with self.lock:
+            if directory not in self.directories:
+                self.directories[directory] = self.scan(directory)
+            path = self.directories[directory].get(key, "")
+            if path and not os.path.exists(path):
+                # Deleted since it was indexed
+                del self.directories[directory][key]
+                path = ""
+        return path
+
+    def add(self, path: str):
+        """Index a new file, if its name matches."""
+        directory, name = os.path.split(path)
+        match = self.regex.match(name)
+        with self.lock:
+            if match and directory in self.directories:
+                self.directories[directory][match.group(1)] = path
+
+    def forget(self, directory: str):
+        """Scan a directory again on its next lookup."""
+        with self.lock:
+            self.directories.pop(directory, None)
+
+
+# Songs downloaded in album cache directories, by video ID
+song_files = DirectoryIndex(r"^.* \[([^\[\]]+)\]\.m4a$")
 
 
 def song_file(song: Song, album_dir: str) -> str:
@@ -126,60 +228,212 @@ def song_file(song: Song, album_dir: str) -> str:
     - the file path, if found
     - "" otherwise
     """
-    if not (os.path.exists(album_dir) and os.path.isdir(album_dir)):
-        return ""
+    return song_files.get(album_dir, song.video_id)
 
-    video_id = song.video_id
-    files_in_album = os.listdir(album_dir)
-    for file_name in files_in_album:
-        regex = re.compile(f".* \[{video_id}\].m4a$")
-        if regex.match(file_name):
-            return os.path.join(album_dir, file_name)
 
-    return ""
+class DownloadJob:
+    """The paths involved in downloading a song and generating its file."""
 
+    def __init__(self, song: Song, root_download_path: str):
+        self.song = song
+        self.songs_dir = os.path.join(root_download_path, "songs")
+        self.album_dir = os.path.join(
+            root_download_path, "caches", escape(song.album.title)
+        )
+        self.song_name = f"{song.title} - {song.album.title} - {song.artist}"
+        self.artwork_hash = artwork_hash(song.album)
+        self.song_filename = short_filename(
+            self.songs_dir, self.song_name, self.artwork_hash, song.video_id
+        )
+        self.song_file_path = os.path.join(self.songs_dir, self.song_filename)
+        self.fingerprint = tag_fingerprint(song)
+        self.downloaded_file_path = ""
+        # The video thumbnail, downloaded only for albums without a custom artwork
+        self.thumbnail_path = ""
+        # The song file generated from the same video, only its tags are updated
+        self.retag_path = ""
+        # Previous versions of the song file, deleted once it is generated
+        self.previous_files = []
+        # The future of the album artwork download, when downloaded ahead
+        self.artwork = None
 
-def download(song: Song, root_download_path: str, overwrite: bool = False):
-    """Download a song from YouTube video and generate file with metadata."""
+    def file_record(self) -> dict:
+        """Describe the generated song file for the files inventory."""
+        stat = os.stat(self.song_file_path)
+        return {
+            "song_id": self.song.id,
+            "path": self.song_file_path,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "artwork_hash": self.artwork_hash,
+            "video_id": self.song.video_id,
+            "fingerprint": self.fingerprint,
+        }
 
-    video_id = song.video_id
 
-    songs_dir = os.path.join(root_download_path, "songs")
-    album_dir = os.path.join(root_download_path, "caches", escape(song.album.title))
+def recorded_file_unchanged(record: SongFile) -> bool:
+    """Return whether a song file is still on disk as recorded in the files inventory."""
+    try:
+        stat = os.stat(record.path)
+    except OSError:
+        return False
+    return stat.st_size == record.size and stat.st_mtime == record.mtime
+
+
+def prepare_download(
+    song: Song,
+    root_download_path: str,
+    overwrite: bool = False,
+    record: SongFile = None,
+) -> DownloadJob:
+    """
+    Make the directories of a song download and find its previous versions,
+    deleted only once the song file is generated, see generate_song_file.
+
+    A song file generated from the same video is kept if its tags fingerprint is
+    unchanged, its tags are updated in place otherwise. With the record of the
+    song in the files inventory, the file system is only looked at to delete a
+    previous version. Without one, e.g. for files generated before the inventory,
+    or if the recorded file was deleted or modified since, the song files are
+    looked for and their fingerprint read.
+    Returns: the download job, None if the song is already present and overwrite is False
+    """
+    job = DownloadJob(song, root_download_path)
+    stale_path = ""
+    if record is not None and not recorded_file_unchanged(record):
+        # Deleted or modified, e.g. truncated, since generated: generated again
+        stale_path, record = record.path, None
+    if record is not None:
+        # Skip download if the song is already present with the same tags
+        if (
+            not overwrite
+            and record.path == job.song_file_path
+            and record.fingerprint == job.fingerprint
+        ):
+            return None
+        previous_files = [record.path] if os.path.exists(record.path) else []
+        same_video = previous_files if record.video_id == song.video_id else []
+    else:
+        # Escape glob characters
+        escaped_song_name = escape(job.song_name).replace("[", "[[]")
+        # Find all previously generated songs from a different video or with a different artwork
+        previous_files = glob(
+            os.path.join(
+                glob_escape(job.songs_dir), f"{escaped_song_name} [[]*] [[]*].m4a"
+            )
+        )
+        same_video = [
+            file
+            for file in previous_files
+            if file.endswith(f"[{song.video_id}].m4a") and file != stale_path
+        ]
+
+    if same_video and not overwrite:
+        if job.song_file_path in same_video:
+            job.retag_path = job.song_file_path
+        # With the custom artwork of the album cleared, the song file is generated
+        # again with the video thumbnail, which a retag would not embed
+        elif song.album.artwork_url:
+            job.retag_path = same_video[0]
+        if (
+            record is None
+            and job.retag_path == job.song_file_path
+            and read_fingerprint(job.song_file_path) == job.fingerprint
+        ):
+            return None
+
     # Generate directories
-    for path in [songs_dir, album_dir]:
+    for path in [job.songs_dir, job.album_dir]:
         if not (os.path.exists(path) and os.path.isdir(path)):
             os.makedirs(path, exist_ok=True)
 
-    song_name = f"{song.title} - {song.album.title} - {song.artist}"
-    artwork_url = song.album.artwork_url
-    if artwork_url is None:
-        artwork_url = ""
-    artwork_hash = hashlib.md5(artwork_url.encode()).hexdigest()
-    song_filename = short_filename(songs_dir, song_name, artwork_hash, video_id)
-    song_file_path = os.path.join(songs_dir, song_filename)
-
-    # Skip download if the song is already present and overwrite is False
-    if os.path.exists(song_file_path) and not overwrite:
-        return
+    job.previous_files = [
+        file
+        for file in previous_files
+        if file not in (job.retag_path, job.song_file_path)
+    ]
+    return job
+
+
+def downloaded_thumbnail(downloaded_file_path: str) -> str:
+    """Return the thumbnail downloaded along with a song, "" if none."""
+    stem = os.path.splitext(downloaded_file_path)[0]
+    for extension in THUMBNAIL_EXTENSIONS:
+        if os.path.exists(f"{stem}.{extension}"):
+            return f"{stem}.{extension}"
+    return ""
 
-    # Escape glob characters
-    escaped_song_name = escape(song_name).replace("[", "[[]")
-    # Find all previously generated songs from a different video or with a different artwork
-    for file in glob(f"{escaped_song_name} [[]*] [[]*].m4a"):
-        # Delete previous version of the song, keep only current one
-        os.remove(file)
 
-    downloaded_file_path = song_file(song, album_dir)
-    if downloaded_file_path:
+def fetch_song_audio(job: DownloadJob):
+    """Download the audio of a song from its YouTube video, unless already downloaded."""
+    song = job.song
+    job.downloaded_file_path = song_file(song, job.album_dir)
+    if job.downloaded_file_path:
         print(
-            f"[=] Song already downloaded: '{song.title}' -> '{downloaded_file_path}'"
+            f"[=] Song already downloaded: '{song.title}' -> '{job.downloaded_file_path}'"
         )
+        job.thumbnail_path = downloaded_thumbnail(job.downloaded_file_path)
+        if not job.thumbnail_path and not song.album.artwork_url:
+            # Downloaded while the album had a custom artwork
+            job.thumbnail_path = download_thumbnail_from_video_id(
+                song.video_id, job.album_dir
+            )
     else:
-        print(f"[+] Downloading '{song_name}'")
-        download_song_from_video_id(video_id, album_dir)
-        downloaded_file_path = song_file(song, album_dir)
-        print(f"[+] Downloaded '{downloaded_file_path}'")
+        print(f"[+] Downloading '{job.song_name}'")
+        downloaded_file_path, job.thumbnail_path = download_song_from_video_id(
+            song.video_id, job.album_dir, thumbnail=not song.album.artwork_url
+        )
+        if downloaded_file_path:
+            song_files.add(downloaded_file_path)
+        else:
+            song_files.forget(job.album_dir)
+        job.downloaded_file_path = song_file(song, job.album_dir)
+        print(f"[+] Downloaded '{job.downloaded_file_path}'")
 
-    print(f"[+] Generating '{song_filename}'")
-    add_metadata(downloaded_file_path, song_file_path, album_dir, song)
+
+def remove_previous_files(job: DownloadJob):
+    """Delete the previous versions of a song file, once it is generated."""
+    if not os.path.exists(job.song_file_path):
+        return
+    for file in job.previous_files:
+        # Keep only the current version of the song
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def generate_song_file(job: DownloadJob):
+    """
+    Generate the song file with its metadata from the downloaded audio, or update
+    the tags of the song file generated from the same video, then delete its
+    previous versions.
+    """
+    if job.retag_path:
+        print(f"[+] Updating the tags of '{job.song_filename}'")
+        if job.retag_path != job.song_file_path:
+            os.replace(job.retag_path, job.song_file_path)
+        retag_song_file(
+            job.song_file_path, job.song, album_artwork(job.song), job.fingerprint
+        )
+    else:
+        print(f"[+] Generating '{job.song_filename}'")
+        add_metadata(
+            job.downloaded_file_path,
+            job.song_file_path,
+            job.song,
+            job.fingerprint,
+            job.thumbnail_path,
+        )
+    remove_previous_files(job)
+
+
+def download(song: Song, root_download_path: str, overwrite: bool = False):
+    """Download a song from YouTube video and generate file with metadata."""
+    job = prepare_download(song, root_download_path, overwrite)
+    if job is None:
+        return
+    if not job.retag_path:
+        try:
+            fetch_song_audio(job)
+        finally:
+            close_song_downloader()
+    generate_song_file(job)
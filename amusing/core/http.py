@@ -0,0 +1,104 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Number of connections kept alive to a host
+DEFAULT_POOL_SIZE = 4
+# Retries of a throttled or failed request, waiting backoff * 2^retry seconds
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+def new_session(
+    pool_size: int = DEFAULT_POOL_SIZE,
+    retries: int = DEFAULT_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+    retry_statuses: list = RETRY_STATUSES,
+    retry_all_methods: bool = False,
+    raise_on_status: bool = True,
+    headers: dict = None,
+) -> requests.Session:
+    """
+    Return a requests session keeping up to pool_size connections alive, which
+    retries throttled requests with an exponential backoff, honouring Retry-After.
+
+    retry_all_methods also retries POST requests, raise_on_status=False returns
+    the last response once retries are exhausted instead of raising.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=retry_statuses,
+        allowed_methods=None if retry_all_methods else Retry.DEFAULT_ALLOWED_METHODS,
+        respect_retry_after_header=True,
+        raise_on_status=raise_on_status,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    if headers:
+        session.headers.update(headers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class RateLimiter:
+    """
+    Allow `rate` calls per second on average and up to `burst` calls at once,
+    across threads. A rate of 0 or less does not limit calls.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Wait until a call is allowed."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class Shared:
+    """
+    An instance shared by the whole process, created on first use from the
+    settings given to configure.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.settings = {}
+        self.instance = None
+        self.lock = threading.Lock()
+
+    def configure(self, **settings):
+        """Update the settings, the instance is created again on next use."""
+        with self.lock:
+            self.settings.update(settings)
+            self.instance = None
+
+    def get(self):
+        with self.lock:
+            if self.instance is None:
+                self.instance = self.factory(**self.settings)
+            return self.instance
@@ -0,0 +1,117 @@
+import os
+
+import pandas as pd
+from sqlalchemy.orm import Session
+
+from amusing.core.parse_csv import (
+    ResolutionCheckpoint,
+    checkpoint_path,
+    process_library,
+    process_removed,
+)
+from amusing.core.parse_xml import (
+    HAS_PARQUET,
+    LIBRARY_COLUMNS,
+    MANIFEST_FILENAME,
+    iter_changed_tracks,
+    iter_library_batches,
+    library_exists,
+    load_manifest,
+    merge_library,
+    print_library_changes,
+    read_library,
+    save_manifest,
+    sort_library,
+    write_library,
+    write_library_chunks,
+)
+from amusing.core.save_to_db import DEFAULT_BATCH_SIZE, BatchWriter
+
+
+def ingest_library_xml(
+    root_download_path: str,
+    lib_path: str,
+    session: Session,
+    incremental: bool = True,
+    export_csv: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    resume: bool = True,
+    threshold: float = None,
+):
+    """
+    Stream the tracks of a Library.xml straight into the db, batch by batch,
+    without going through an intermediate Library.csv.
+
+    When incremental, only the tracks added or modified since the previous parse
+    are ingested, and merged into the kept library. Tracks are held in memory and
+    written to the db batch_size at a time. A full parse is written to the kept
+    library as the batches are ingested, in the order of the XML, and sorted by
+    the next incremental parse. When resuming, the video IDs resolved by an
+    interrupted run are reused. With a threshold, YouTube Music results are
+    matched without asking.
+    A Library.csv is written when export_csv is set, and an existing one is
+    always kept up to date, as is the columnar snapshot. Songs removed from the
+    library can only be found, and deleted from the db, through one of them.
+
+    Returns: error
+    """
+    try:
+        library_path = os.path.join(root_download_path, "Library.csv")
+        manifest_path = os.path.join(root_download_path, MANIFEST_FILENAME)
+        has_csv = os.path.exists(library_path)
+        export_csv = export_csv or has_csv
+        keep_library = export_csv or HAS_PARQUET
+        previous = {}
+        # A library that is kept on disk has to start from a full parse
+        if incremental and (library_exists(library_path) or not keep_library):
+            previous = load_manifest(manifest_path)
+
+        manifest = {}
+        tracks = iter_changed_tracks(lib_path, previous, manifest)
+
+        def ingested_batches():
+            ingested = 0
+            with BatchWriter(session, batch_size) as writer, ResolutionCheckpoint(
+                checkpoint_path(library_path), writer, resume
+            ) as checkpoint:
+                for batch in iter_library_batches(tracks, batch_size):
+                    batch = process_library(
+                        batch, writer, checkpoint=checkpoint, threshold=threshold
+                    )
+                    writer.commit()
+                    ingested += len(batch)
+                    print(f"[+] Ingested {ingested} tracks")
+                    yield batch
+
+        if previous:
+            # Only the song keys are needed unless the library is kept on disk
+            changes = [
+                batch[LIBRARY_COLUMNS]
+                if keep_library
+                else batch[["Title", "Artist", "Album", "Persistent ID"]]
+                for batch in ingested_batches()
+            ]
+            changes = (
+                pd.concat(changes, ignore_index=True).reindex(columns=LIBRARY_COLUMNS)
+                if changes
+                else pd.DataFrame(columns=LIBRARY_COLUMNS)
+            )
+            print_library_changes(set(changes["Persistent ID"]), previous, manifest)
+            if keep_library:
+                library, removed = merge_library(
+                    read_library(library_path),
+                    changes,
+                    previous.keys() - manifest.keys(),
+                )
+                process_removed(removed, session)
+                write_library(sort_library(library), library_path, export_csv)
+        elif keep_library:
+            # A full parse is written batch by batch, in the order of the XML
+            write_library_chunks(ingested_batches(), library_path, export_csv)
+        else:
+            for _ in ingested_batches():
+                pass
+        save_manifest(manifest_path, manifest)
+    except Exception as e:
+        print("Something went wrong in ingesting your Library XML file: ", e)
+        return 1
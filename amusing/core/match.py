@@ -0,0 +1,98 @@
+import json
+import re
+from difflib import SequenceMatcher
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from unidecode import unidecode
+
+from amusing.db.models import ReviewItem, Song
+
+# Score above which a YouTube Music result is accepted without asking
+DEFAULT_MATCH_THRESHOLD = 0.8
+# Weight of each field in the score of a result
+MATCH_WEIGHTS = {"title": 0.5, "artist": 0.3, "album": 0.1, "duration": 0.1}
+# Difference in seconds from which durations do not match at all
+MAX_DURATION_DIFFERENCE = 30
+
+# Details like "(feat. X)" or "[Remastered]" are left out of the comparison
+BRACKETS_REGEX = re.compile(r"\([^)]*\)|\[[^\]]*\]")
+PUNCTUATION_REGEX = re.compile(r"[^\w\s]")
+
+
+def normalize_text(text: str) -> str:
+    """Normalize a title, artist or album name to compare it."""
+    text = BRACKETS_REGEX.sub(" ", unidecode(str(text or "")).casefold())
+    return " ".join(PUNCTUATION_REGEX.sub(" ", text).split())
+
+
+def text_similarity(a: str, b: str) -> float:
+    """Similarity between 0 and 1 of two names, once normalized."""
+    a, b = normalize_text(a), normalize_text(b)
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def artist_similarity(artist: str, result: dict) -> float:
+    """Similarity of an artist with the best matching artist of a result."""
+    names = [artist["name"] for artist in result.get("artists") or []]
+    joined = ", ".join(names)
+    return max(
+        [text_similarity(artist, name) for name in names + [joined]], default=0.0
+    )
+
+
+def score_result(song: Song, result: dict, duration: float = None) -> float:
+    """
+    Score between 0 and 1 how well a YouTube Music result matches a song.
+
+    The duration of the song in seconds is only compared if known, the weights
+    of the other fields are scaled accordingly.
+    """
+    album = (result.get("album") or {}).get("name")
+    scores = {
+        "title": text_similarity(song.title, result.get("title")),
+        "artist": artist_similarity(song.artist, result),
+    }
+    if album:
+        scores["album"] = text_similarity(song.album.title, album)
+    if duration and result.get("duration_seconds"):
+        difference = abs(duration - result["duration_seconds"])
+        scores["duration"] = max(0.0, 1 - difference / MAX_DURATION_DIFFERENCE)
+
+    total_weight = sum(MATCH_WEIGHTS[field] for field in scores)
+    return sum(MATCH_WEIGHTS[field] * score for field, score in scores.items()) / (
+        total_weight
+    )
+
+
+def rank_results(song: Song, results: list, duration: float = None) -> list:
+    """Return (score, result) pairs of YouTube Music results, best match first."""
+    scored = [(score_result(song, result, duration), result) for result in results]
+    return sorted(scored, key=lambda pair: pair[0], reverse=True)
+
+
+def queue_for_review(song: Song, ranked: list, session: Session):
+    """Add a song that could not be matched with confidence to the review queue."""
+    item = reviewed_item(song, session) or ReviewItem(
+        title=song.title, artist=song.artist, album=song.album.title
+    )
+    item.candidates = json.dumps(
+        [{**result, "score": round(score, 3)} for score, result in ranked]
+    )
+    item.score = ranked[0][0] if ranked else 0.0
+    session.add(item)
+
+
+def reviewed_item(song: Song, session: Session) -> ReviewItem:
+    """Return the review queue item of a song, if any."""
+    return session.scalars(
+        select(ReviewItem).where(
+            ReviewItem.title == song.title,
+            ReviewItem.artist == song.artist,
+            ReviewItem.album == song.album.title,
+        )
+    ).first()
@@ -1,10 +1,25 @@
 import re
-import sys
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
-import requests
 import typer
 
+from amusing.core.musicbrainz_client import (
+    COVER_ART_THUMBNAIL_SIZE,
+    MusicBrainzError,
+    get_musicbrainz_client,
+)
+from amusing.core.musicbrainz_index import get_musicbrainz_index
+
+RELEASE_INCLUDES = "artist-credits+media+recordings"
+# Also the works recorded by the tracks of a release, with their composers
+ENRICHED_RELEASE_INCLUDES = (
+    RELEASE_INCLUDES + "+recording-level-rels+work-rels+work-level-rels+artist-rels"
+)
+# Maximum number of recordings MusicBrainz browses in one request
+RECORDINGS_PAGE_SIZE = 100
+ENRICH_WORKERS = 4
+
 
 def sanitize_input(input_str: str) -> str:
     """Remove non-alphanumeric characters (excluding whitespace) from input."""
@@ -16,39 +31,55 @@ def fetch_metadata_by_id(
     entity_id: str,
     include_params: str = "artist-credits+releases+media",
 ):
-    """Fetch metadata for a song or album using its MusicBrainz ID."""
-    url = f"https://musicbrainz.org/ws/2/{entity_type}/{entity_id}"
-    response = requests.get(url, params={"fmt": "json", "inc": include_params})
-    if response.status_code != 200:
+    """
+    Fetch metadata for a song or album using its MusicBrainz ID.
+
+    Releases are read from the local MusicBrainz index first, if any.
+    Raises: MusicBrainzError if it could not be fetched
+    """
+    index = get_musicbrainz_index()
+    if index and entity_type == "release":
+        metadata = index.release(entity_id)
+        if metadata:
+            return metadata
+    try:
+        return get_musicbrainz_client().musicbrainz(
+            f"{entity_type}/{entity_id}", {"inc": include_params}
+        )
+    except MusicBrainzError as e:
         typer.secho(
-            f"Error fetching {entity_type} metadata by ID, response code= {response.status_code}",
+            f"Error fetching {entity_type} metadata by ID: {e}",
             fg=typer.colors.RED,
         )
-        sys.exit(1)
-
-    return response.json()
+        raise
 
 
 def search_songs_metadata(
     title: str, artist: Optional[str] = None, album: Optional[str] = None
 ):
-    """Search for songs based on title, artist, and album."""
+    """
+    Search for songs based on title, artist, and album, in the local MusicBrainz
+    index first if any.
+
+    Raises: MusicBrainzError if the search failed
+    """
     query = f'track:"{sanitize_input(title)}"'
     if artist:
         query += f' AND artist:"{sanitize_input(artist)}"'
     if album:
         query += f' AND release:"{sanitize_input(album)}"'
     typer.echo(f"Searching for: {query}")
-    response = requests.get(
-        "https://musicbrainz.org/ws/2/recording/",
-        params={"query": query, "fmt": "json"},
-    )
-
-    if response.status_code != 200:
-        typer.secho("Error fetching song metadata", fg=typer.colors.RED)
-        sys.exit(1)
-
-    results = response.json().get("recordings", [])
+    index = get_musicbrainz_index()
+    results = index.search_recordings(title, artist, album) if index else []
+    if not results:
+        try:
+            response = get_musicbrainz_client().musicbrainz(
+                "recording/", {"query": query}
+            )
+        except MusicBrainzError:
+            typer.secho("Error fetching song metadata", fg=typer.colors.RED)
+            raise
+        results = response.get("recordings", [])
     if not results:
         typer.secho("No results found!", fg=typer.colors.YELLOW)
         use_id = typer.confirm(
@@ -200,31 +231,84 @@ def search_songs_metadata(
         return None
 
 
-def song_metadata_from_mb_json(song_metadata: dict) -> dict:
+def track_composers(recording: dict) -> str:
+    """Return the composers of the works a recording is a performance of, if any."""
+    composers = []
+    for relation in recording.get("relations", []):
+        for work_relation in (relation.get("work") or {}).get("relations", []):
+            name = (work_relation.get("artist") or {}).get("name")
+            if work_relation.get("type") == "composer" and name not in composers:
+                composers.append(name)
+    return ", ".join(composers)
+
+
+def track_metadata_from_mb_json(
+    album_metadata: dict, medium: dict, track: dict, genres: dict = None
+) -> dict:
+    """Build the metadata of a song from a track of a release with its recordings."""
+    recording = track.get("recording", {})
+    artist_credit = (
+        track.get("artist-credit")
+        or recording.get("artist-credit")
+        or album_metadata.get("artist-credit", [{}])
+    )
     return {
-        "album_name": song_metadata.get("releases", [{}])[0].get("title", None),
-        "title": song_metadata.get("title"),
-        "artist": song_metadata.get("artist-credit", [{}])[0]
-        .get("artist", {})
-        .get("name", "Unknown Artist"),
-        "composer": ", ".join(
-            [
-                composer.get("name")
-                for composer in song_metadata.get("artist-credit", [{}])
-                if composer.get("name")
-            ]
+        "album_name": album_metadata.get("title"),
+        "title": track.get("title") or recording.get("title"),
+        "artist": artist_credit[0].get("artist", {}).get("name", "Unknown Artist"),
+        "composer": track_composers(recording)
+        or ", ".join(
+            [composer.get("name") for composer in artist_credit if composer.get("name")]
         ),
-        "genre": song_metadata.get("tags", [{}])[0].get("name", None),
-        "track_number": song_metadata.get("releases", [{}])[0]
-        .get("media", [{}])[0]
-        .get("tracks", [{}])[0]
-        .get("number", None),
-        "disc_number": song_metadata.get("releases", [{}])[0]
-        .get("media", [{}])[0]
-        .get("position", None),
+        "genre": (genres or {}).get(recording.get("id")),
+        "track_number": track.get("position"),
+        "disc_number": medium.get("position"),
     }
 
 
+def fetch_recording_genres(album_id: str, album_metadata: dict) -> dict:
+    """
+    Fetch the most voted genre of each recording of a release, by pages of recordings
+    fetched concurrently within the MusicBrainz rate limit.
+
+    Returns: recording ID -> genre, a recording without genre is left out
+    """
+    track_count = sum(
+        medium.get("track-count", 0) for medium in album_metadata.get("media", [])
+    )
+
+    def fetch_page(offset: int) -> list:
+        return get_musicbrainz_client().musicbrainz(
+            "recording",
+            {
+                "release": album_id,
+                "inc": "genres",
+                "limit": RECORDINGS_PAGE_SIZE,
+                "offset": offset,
+            },
+        )["recordings"]
+
+    genres = {}
+    with ThreadPoolExecutor(ENRICH_WORKERS) as executor:
+        pages = executor.map(
+            fetch_page, range(0, max(track_count, 1), RECORDINGS_PAGE_SIZE)
+        )
+        try:
+            for recordings in pages:
+                for recording in recordings:
+                    ranked = sorted(
+                        recording.get("genres", []),
+                        key=lambda genre: genre.get("count", 0),
+                        reverse=True,
+                    )
+                    if ranked:
+                        genres[recording["id"]] = ranked[0]["name"]
+        except MusicBrainzError as e:
+            # Genres are only a nice to have
+            typer.secho(f"Error fetching genres: {e}", fg=typer.colors.YELLOW)
+    return genres
+
+
 def album_metadata_from_mb_json(album_metadata: dict) -> dict:
     return {
         "id": album_metadata.get("id"),
@@ -237,28 +321,40 @@ def album_metadata_from_mb_json(album_metadata: dict) -> dict:
     }
 
 
-def search_album_metadata(album: str, artist: Optional[str] = None):
-    """Search for an album and fetch metadata for the album and its songs."""
+def search_album_metadata(
+    album: str, artist: Optional[str] = None, enrich: bool = False
+):
+    """
+    Search for an album and fetch metadata for the album and its songs.
+
+    Albums are searched in the local MusicBrainz index first, if any.
+    The tracklist is read from the release itself. With enrich, the composers of
+    the songs are read from the works they record, at no extra request, and
+    their genres are fetched by pages of recordings.
+
+    Raises: MusicBrainzError if the search failed
+    """
     query = f'release:"{album}"'
 
     if artist:
         query += f' AND artist:"{artist}"'
 
-    response = requests.get(
-        "https://musicbrainz.org/ws/2/release/",
-        params={"query": query, "fmt": "json"},
-    )
-
-    if response.status_code != 200:
-        typer.secho("Error fetching album metadata", fg=typer.colors.RED)
-        sys.exit(1)
-
-    results = response.json().get("releases", [])
+    index = get_musicbrainz_index()
+    results = index.search_releases(album, artist) if index else []
+    if not results:
+        try:
+            response = get_musicbrainz_client().musicbrainz(
+                "release/", {"query": query}
+            )
+        except MusicBrainzError:
+            typer.secho("Error fetching album metadata", fg=typer.colors.RED)
+            raise
+        results = response.get("releases", [])
     if not results:
         typer.secho("No results found!", fg=typer.colors.YELLOW)
         album_id = typer.prompt("Enter the MusicBrainz release ID or q to exit: ")
         if album_id == "q":
-            sys.exit(1)
+            raise typer.Exit(1)
     else:
         for idx, release in enumerate(results):
             typer.echo(
@@ -271,9 +367,11 @@ def search_album_metadata(album: str, artist: Optional[str] = None):
             album_id = album_metadata.get("id")
         else:
             typer.secho("Invalid choice!", fg=typer.colors.RED)
-            sys.exit(1)
+            raise typer.Exit(1)
     album_metadata = fetch_metadata_by_id(
-        "release", album_id, include_params="artist-credits+media+recordings"
+        "release",
+        album_id,
+        include_params=ENRICHED_RELEASE_INCLUDES if enrich else RELEASE_INCLUDES,
     )
     artwork_url = get_album_artwork(album_id)
     album_to_return = album_metadata_from_mb_json(album_metadata)
@@ -289,25 +387,29 @@ def search_album_metadata(album: str, artist: Optional[str] = None):
     typer.echo("\nFetching tracklist...")
     if "media" in album_metadata:
         typer.echo("\nTracklist and metadata:")
-        track_list = []
-        for medium in album_metadata["media"]:
-            for track in medium.get("tracks", []):
-                track_metadata = fetch_metadata_by_id(
-                    "recording",
-                    track.get("recording", {}).get("id", ""),
-                    include_params="artist-credits+releases+media",
-                )
-                # typer.echo(track_metadata["title"], "-", track_metadata["id"])
-                track_list.append(song_metadata_from_mb_json(track_metadata))
-        album_to_return["track_list"] = track_list
+        genres = fetch_recording_genres(album_id, album_metadata) if enrich else {}
+        album_to_return["track_list"] = [
+            track_metadata_from_mb_json(album_metadata, medium, track, genres)
+            for medium in album_metadata["media"]
+            for track in medium.get("tracks", [])
+        ]
     return album_to_return
 
 
 def get_album_artwork(album_id: str) -> str:
     """Fetch the artwork URL for an album using the Cover Art Archive API."""
-    response = requests.get(f"https://coverartarchive.org/release/{album_id}")
-    if response.status_code == 200:
-        images = response.json().get("images", [])
-        if images:
-            return images[0].get("image", "No Artwork Available")
-    return "No Artwork Available"
+    index = get_musicbrainz_index()
+    artwork_url = index.artwork_url(album_id) if index else None
+    if artwork_url:
+        return artwork_url
+    try:
+        images = get_musicbrainz_client().cover_art(f"release/{album_id}")["images"]
+    except (MusicBrainzError, KeyError):
+        return "No Artwork Available"
+    if not images:
+        return "No Artwork Available"
+    # The front cover, at the size of its thumbnail closest to the embedded artwork
+    image = next((image for image in images if image.get("front")), images[0])
+    return image.get("thumbnails", {}).get(COVER_ART_THUMBNAIL_SIZE) or image.get(
+        "image", "No Artwork Available"
+    )
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from importlib import metadata
+
+import requests
+
+from amusing.core.http import RateLimiter, Shared, new_session
+from amusing.utils.funcs import save_json_atomic
+
+MUSICBRAINZ_URL = "https://musicbrainz.org/ws/2"
+COVER_ART_ARCHIVE_URL = "https://coverartarchive.org"
+# Smallest Cover Art Archive thumbnail no smaller than the embedded 600x600 artwork
+COVER_ART_THUMBNAIL_SIZE = "1200"
+
+# MusicBrainz allows a single request per second, with a small burst
+DEFAULT_REQUESTS_PER_SECOND = 1.0
+DEFAULT_BURST = 1
+DEFAULT_POOL_SIZE = 4
+DEFAULT_TIMEOUT = 30
+# Retries of a throttled (503) or failed request
+DEFAULT_RETRIES = 5
+RETRY_STATUSES = [500, 502, 503, 504]
+# Seconds a cached response is used without asking MusicBrainz if it changed
+DEFAULT_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+# Statuses of the responses kept in the cache, a missing cover art is cached too
+CACHED_STATUSES = [200, 404]
+
+
+class MusicBrainzError(RuntimeError):
+    """A MusicBrainz or Cover Art Archive request that did not succeed."""
+
+    def __init__(self, url: str, status_code: int = None, reason: str = None):
+        reason = f"response code= {status_code}" if status_code else reason
+        super().__init__(f"request to {url} failed, {reason}")
+        self.status_code = status_code
+
+
+def user_agent() -> str:
+    """MusicBrainz asks for a User-Agent identifying the application."""
+    try:
+        version = metadata.version("amusing-app")
+    except metadata.PackageNotFoundError:
+        version = "unknown"
+    return f"amusing-app/{version} ( https://github.com/yashprakash13/amusing )"
+
+
+class MusicBrainzClient:
+    """
+    A MusicBrainz and Cover Art Archive client shared by the whole process.
+
+    Requests go through a single pooled HTTP session, MusicBrainz ones are rate
+    limited, and throttled ones are retried. Responses are cached on disk in
+    cache_dir if given: a cached response is used as is for cache_max_age
+    seconds, then revalidated with its ETag.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = None,
+        requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        retries: int = DEFAULT_RETRIES,
+        cache_max_age: float = DEFAULT_CACHE_MAX_AGE,
+    ):
+        self.cache_dir = cache_dir
+        self.cache_max_age = cache_max_age
+        self.cache_lock = threading.Lock()
+        self.limiter = RateLimiter(requests_per_second, DEFAULT_BURST)
+        self.session = new_session(
+            pool_size,
+            retries,
+            retry_statuses=RETRY_STATUSES,
+            # The last response is returned to report its status
+            raise_on_status=False,
+            headers={"User-Agent": user_agent(), "Accept": "application/json"},
+        )
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_path(self, url: str, params: dict) -> str:
+        """Return the path of the cached response of a request."""
+        key = json.dumps([url, sorted((params or {}).items())])
+        return os.path.join(
+            self.cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".json"
+        )
+
+    def load_cached(self, path: str) -> dict:
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def save_cached(self, path: str, entry: dict):
+        if path is not None:
+            with self.cache_lock:
+                save_json_atomic(path, entry)
+
+    def get_json(self, url: str, params: dict = None, rate_limited: bool = True):
+        """
+        Return the JSON response of a GET request, from the cache if possible.
+
+        Raises: MusicBrainzError if the response is not successful
+        """
+        path = self.cache_path(url, params) if self.cache_dir else None
+        cached = self.load_cached(path)
+        if cached and time.time() - cached["fetched_at"] < self.cache_max_age:
+            return self.cached_json(url, cached)
+
+        headers = {}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if rate_limited:
+            self.limiter.wait()
+        try:
+            response = self.session.get(
+                url, params=params, headers=headers, timeout=DEFAULT_TIMEOUT
+            )
+        except requests.RequestException as e:
+            raise MusicBrainzError(url, reason=str(e)) from e
+        if response.status_code == 304 and cached:
+            cached["fetched_at"] = time.time()
+            self.save_cached(path, cached)
+            return self.cached_json(url, cached)
+        if response.status_code in CACHED_STATUSES:
+            cached = {
+                "status": response.status_code,
+                "etag": response.headers.get("ETag"),
+                "fetched_at": time.time(),
+                "data": response.json() if response.status_code == 200 else None,
+            }
+            self.save_cached(path, cached)
+            return self.cached_json(url, cached)
+        raise MusicBrainzError(url, response.status_code)
+
+    def cached_json(self, url: str, cached: dict):
+        if cached["status"] != 200:
+            raise MusicBrainzError(url, cached["status"])
+        return cached["data"]
+
+    def musicbrainz(self, path: str, params: dict = None):
+        """Return the JSON response of a MusicBrainz web service path."""
+        return self.get_json(
+            f"{MUSICBRAINZ_URL}/{path}", {**(params or {}), "fmt": "json"}
+        )
+
+    def cover_art(self, path: str):
+        """Return the JSON response of a Cover Art Archive path, not rate limited."""
+        return self.get_json(f"{COVER_ART_ARCHIVE_URL}/{path}", rate_limited=False)
+
+
+_client = Shared(MusicBrainzClient)
+
+
+def configure_musicbrainz_client(**settings):
+    """
+    Set the cache_dir, requests_per_second, pool_size, retries or cache_max_age
+    of the shared MusicBrainz client, before it is first used.
+    """
+    _client.configure(**settings)
+
+
+def get_musicbrainz_client() -> MusicBrainzClient:
+    """Return the MusicBrainz client shared by the whole process."""
+    return _client.get()
@@ -0,0 +1,266 @@
+import json
+import os
+import sqlite3
+import tarfile
+import threading
+
+from amusing.core.musicbrainz_client import (
+    COVER_ART_ARCHIVE_URL,
+    COVER_ART_THUMBNAIL_SIZE,
+)
+
+# Name of the local MusicBrainz index, in the root download path
+INDEX_FILENAME = "musicbrainz.db"
+# Number of results of a search, as for the MusicBrainz web service
+SEARCH_LIMIT = 25
+# Number of releases written to the index per transaction
+IMPORT_BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE releases (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE VIRTUAL TABLE release_search USING fts5(
+    id UNINDEXED, title, artist, tokenize="unicode61 remove_diacritics 2"
+);
+CREATE VIRTUAL TABLE recording_search USING fts5(
+    id UNINDEXED, release_id UNINDEXED, disc UNINDEXED, track UNINDEXED,
+    title, artist, release, tokenize="unicode61 remove_diacritics 2"
+);
+"""
+
+
+def artist_credit_name(artist_credit: list) -> str:
+    """Return the credited name of an artist credit, e.g. "Artist feat. Other"."""
+    return "".join(
+        credit.get("name", "") + credit.get("joinphrase", "")
+        for credit in artist_credit or []
+    )
+
+
+def iter_dump_releases(dump_path: str):
+    """
+    Stream the releases of a MusicBrainz JSON dump, either the release dump
+    archive (mbdump/release inside a tar file) or a file of one release per line.
+    """
+    if tarfile.is_tarfile(dump_path):
+        with tarfile.open(dump_path, "r:*") as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith("mbdump/release"):
+                    for line in archive.extractfile(member):
+                        yield json.loads(line)
+        return
+
+    with open(dump_path, "r") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def search_rows(release: dict):
+    """Return the rows of a release for the release and recording search tables."""
+    artist = artist_credit_name(release.get("artist-credit"))
+    recordings = []
+    for medium in release.get("media", []):
+        for track in medium.get("tracks", []):
+            recording = track.get("recording", {})
+            recordings.append(
+                (
+                    recording.get("id"),
+                    release["id"],
+                    medium.get("position"),
+                    track.get("position"),
+                    track.get("title") or recording.get("title", ""),
+                    artist_credit_name(
+                        track.get("artist-credit") or recording.get("artist-credit")
+                    )
+                    or artist,
+                    release.get("title", ""),
+                )
+            )
+    return (release["id"], release.get("title", ""), artist), recordings
+
+
+def fill_search_tables(connection: sqlite3.Connection):
+    """Index the titles and artists of the releases and their tracks, once imported."""
+    releases = connection.execute("SELECT data FROM releases")
+    while batch := releases.fetchmany(IMPORT_BATCH_SIZE):
+        rows = [search_rows(json.loads(data)) for (data,) in batch]
+        connection.executemany(
+            "INSERT INTO release_search VALUES (?, ?, ?)",
+            [release_row for release_row, _ in rows],
+        )
+        connection.executemany(
+            "INSERT INTO recording_search VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [recording for _, recordings in rows for recording in recordings],
+        )
+
+
+def build_index(dump_path: str, index_path: str) -> int:
+    """
+    Build a local MusicBrainz index from a JSON dump of releases.
+
+    A release listed more than once, e.g. in overlapping dumps, is indexed once,
+    as last listed: releases are imported first, then searchable.
+    The index is written aside and only replaces an existing one once complete.
+    Returns: the number of releases indexed
+    """
+    temp_path = f"{index_path}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    connection = sqlite3.connect(temp_path)
+    connection.executescript(SCHEMA)
+
+    count = 0
+    batch = []
+
+    def write_batch():
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO releases VALUES (?, ?)", batch
+            )
+        batch.clear()
+
+    for release in iter_dump_releases(dump_path):
+        batch.append((release["id"], json.dumps(release)))
+        count += 1
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            write_batch()
+            print(f"[+] Imported {count} releases")
+    write_batch()
+    fill_search_tables(connection)
+    connection.execute("INSERT INTO release_search(release_search) VALUES('optimize')")
+    connection.execute(
+        "INSERT INTO recording_search(recording_search) VALUES('optimize')"
+    )
+    connection.commit()
+    (count,) = connection.execute("SELECT COUNT(*) FROM releases").fetchone()
+    connection.close()
+    os.replace(temp_path, index_path)
+    return count
+
+
+def fts_query(**fields) -> str:
+    """Build a full-text query matching every given field with a phrase."""
+    phrases = []
+    for column, text in fields.items():
+        if text:
+            text = str(text).replace('"', '""')
+            phrases.append(f'{column} : "{text}"')
+    return " AND ".join(phrases)
+
+
+class MusicBrainzIndex:
+    """
+    A local MusicBrainz index built from a JSON dump, searched like the
+    MusicBrainz web service and returning the same JSON.
+    """
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self.local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # A SQLite connection can only be used by the thread that made it
+        if not hasattr(self.local, "connection"):
+            self.local.connection = sqlite3.connect(
+                f"file:{self.index_path}?mode=ro", uri=True
+            )
+        return self.local.connection
+
+    def release(self, release_id: str) -> dict:
+        """Return a release with its media, tracks and recordings, None if unknown."""
+        row = self.connection.execute(
+            "SELECT data FROM releases WHERE id = ?", (release_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def search_releases(self, title: str, artist: str = None) -> list:
+        """Search releases by title and artist, best matches first."""
+        query = fts_query(title=title, artist=artist)
+        if not query:
+            return []
+        rows = self.connection.execute(
+            "SELECT releases.data FROM release_search"
+            " JOIN releases ON releases.id = release_search.id"
+            " WHERE release_search MATCH ? ORDER BY rank LIMIT ?",
+            (query, SEARCH_LIMIT),
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def search_recordings(
+        self, title: str, artist: str = None, album: str = None
+    ) -> list:
+        """
+        Search recordings by title, artist and release, best matches first, in the
+        format of the recording search of the MusicBrainz web service.
+        """
+        query = fts_query(title=title, artist=artist, release=album)
+        if not query:
+            return []
+        rows = self.connection.execute(
+            "SELECT id, release_id, disc, track FROM recording_search"
+            " WHERE recording_search MATCH ? ORDER BY rank LIMIT ?",
+            (query, SEARCH_LIMIT),
+        ).fetchall()
+        return [
+            self.recording(recording_id, release_id, disc, track)
+            for recording_id, release_id, disc, track in rows
+        ]
+
+    def recording(self, recording_id: str, release_id: str, disc, track) -> dict:
+        """Build the recording of a track of a release, as found by a MusicBrainz search."""
+        release = self.release(release_id)
+        medium = next(
+            medium for medium in release["media"] if medium.get("position") == disc
+        )
+        track = next(item for item in medium["tracks"] if item.get("position") == track)
+        recording = track.get("recording", {})
+        track_entry = [{"number": track.get("number"), "position": track["position"]}]
+        return {
+            "id": recording_id,
+            "title": track.get("title") or recording.get("title"),
+            "artist-credit": track.get("artist-credit")
+            or recording.get("artist-credit")
+            or release.get("artist-credit", []),
+            "releases": [
+                {
+                    "id": release["id"],
+                    "title": release.get("title"),
+                    "date": release.get("date"),
+                    "media": [
+                        {
+                            "position": disc,
+                            "track": track_entry,
+                            "tracks": track_entry,
+                        }
+                    ],
+                }
+            ],
+        }
+
+    def artwork_url(self, release_id: str) -> str:
+        """Return the front cover thumbnail URL of a release if the dump says it has one."""
+        release = self.release(release_id)
+        if release and release.get("cover-art-archive", {}).get("front"):
+            front = f"front-{COVER_ART_THUMBNAIL_SIZE}"
+            return f"{COVER_ART_ARCHIVE_URL}/release/{release_id}/{front}"
+        return None
+
+
+_index = None
+_index_path = None
+
+
+def configure_musicbrainz_index(index_path: str):
+    """Set the path of the local MusicBrainz index, used if it exists."""
+    global _index, _index_path
+    _index_path = index_path
+    _index = None
+
+
+def get_musicbrainz_index() -> MusicBrainzIndex:
+    """Return the local MusicBrainz index, None if none was built."""
+    global _index
+    if _index is None and _index_path and os.path.exists(_index_path):
+        _index = MusicBrainzIndex(_index_path)
+    return _index
@@ -1,83 +1,237 @@
+import json
+import os
+
 import pandas as pd
+from sqlalchemy import delete, update
 from sqlalchemy.orm import Session
 from unidecode import unidecode
 
-from amusing.core.parse_xml import sort_library
-from amusing.core.search import search
-from amusing.db.models import Album, Song
+from amusing.core.parse_xml import (
+    iter_library_chunks,
+    read_library,
+    sort_library,
+    write_library,
+    write_library_chunks,
+)
+from amusing.core.save_to_db import DEFAULT_BATCH_SIZE, BatchWriter
+from amusing.core.search import prefetch_search_results, search, song_query
+from amusing.db.models import Album, Organizer, Song, SongFile
+from amusing.utils.funcs import save_json_atomic
+
+# Columns identifying a song of the library in the db
+SONG_KEYS = ["Title", "Artist", "Album ID"]
+
+# Number of video IDs resolved between two checkpoints
+CHECKPOINT_INTERVAL = 25
+
+# Number of songs searched concurrently before their albums are processed
+SEARCH_WINDOW = 200
+
+# Number of rows held in memory when processing a library chunk by chunk
+DEFAULT_CHUNK_SIZE = 5000
+# Columns needed to process a library, and the repetitive ones among them
+PROCESS_COLUMNS = [
+    "Title",
+    "Album",
+    "Album Artist",
+    "Video ID",
+    "Artwork URL",
+    "Artist",
+    "Composer",
+    "Genre",
+    "Release Date",
+    "Disc Number",
+    "Track Count",
+    "Track Number",
+    "Total Time",
+    "Persistent ID",
+]
+CATEGORY_COLUMNS = ["Album", "Artist", "Genre"]
+# Columns of the library updated by processing
+UPDATED_COLUMNS = ["Video ID", "Artwork URL"]
+# Number of values looked up in the db per query, below the SQLite variables limit
+LOOKUP_BATCH_SIZE = 500
+
 
+class ResolutionCheckpoint:
+    """
+    Periodically and atomically save the video IDs resolved so far, along with
+    the db batch they belong to, so that an interrupted run can be resumed
+    without searching them again.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        writer: BatchWriter,
+        resume: bool = True,
+        interval: int = CHECKPOINT_INTERVAL,
+    ):
+        self.path = path
+        self.writer = writer
+        self.interval = interval
+        self.unsaved = 0
+        self.resolved = {}
+        if resume and os.path.exists(path):
+            with open(path, "r") as file:
+                for title, artist, album, video_id in json.load(file):
+                    self.resolved[(title, artist, album)] = video_id
+            print(f"[=] Resuming with {len(self.resolved)} already resolved songs")
+
+    def get(self, title: str, artist: str, album: str) -> str:
+        """Return the video ID resolved for a song by a previous run, if any."""
+        return self.resolved.get((title, artist, album), "")
+
+    def add(self, title: str, artist: str, album: str, video_id: str):
+        """Record a resolved video ID, saving a checkpoint every interval songs."""
+        self.resolved[(title, artist, album)] = video_id
+        self.unsaved += 1
+        if self.unsaved >= self.interval:
+            self.save()
+
+    def save(self):
+        """Commit the current db batch and save the resolved video IDs."""
+        self.writer.commit()
+        save_json_atomic(
+            self.path, [[*key, video_id] for key, video_id in self.resolved.items()]
+        )
+        self.unsaved = 0
 
-def get_video_id(song: Song) -> str:
-    """Return YouTube video ID of a song, searching it on YouTube Music if necessary."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            # Everything was processed, nothing left to resume
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        else:
+            self.save()
+
+
+def get_video_id(
+    song: Song, session: Session = None, threshold: float = None, duration: float = None
+) -> str:
+    """
+    Return YouTube video ID of a song, searching it on YouTube Music if necessary.
+
+    Searches go through the search cache of the db of the given session. With a
+    threshold, the best scored result is chosen without asking, see search.
+    """
     # Check if one was already assigned
     video_id = song.video_id
     if video_id:
         return song.video_id
 
-    return search(song).video_id
+    return search(song, session, threshold, duration).video_id
+
 
+def batched(values: list, size: int = LOOKUP_BATCH_SIZE):
+    """Split values in lists of at most size values."""
+    for start in range(0, len(values), size):
+        yield values[start : start + size]
 
-def process_album(group: pd.DataFrame, album: Album, session: Session) -> pd.DataFrame:
-    """Helper function to process each album and songs present within it from the csv."""
+
+def db_albums(session: Session, titles: list) -> pd.DataFrame:
+    """Load the id and artwork URL of the albums with the given titles."""
+    albums = pd.DataFrame(
+        [
+            row
+            for batch in batched(titles)
+            for row in session.query(Album.id, Album.title, Album.artwork_url)
+            .filter(Album.title.in_(batch))
+            .order_by(Album.id)
+        ],
+        columns=["Album ID", "Album", "DB Artwork URL"],
+    )
+    # Like a query by title, the first album found is the one used
+    return albums.drop_duplicates("Album")
+
+
+def db_songs(session: Session, album_ids: list) -> pd.DataFrame:
+    """Load the key and video ID of the songs of the given albums."""
+    songs = pd.DataFrame(
+        [
+            row
+            for batch in batched(album_ids)
+            for row in session.query(
+                Song.id, Song.title, Song.artist, Song.album_id, Song.video_id
+            )
+            .filter(Song.album_id.in_(batch))
+            .order_by(Song.id)
+        ],
+        columns=["Song ID", "Title", "Artist", "Album ID", "DB Video ID"],
+    )
+    return songs.drop_duplicates(SONG_KEYS)
+
+
+def match_db(rows: pd.DataFrame, session: Session) -> pd.DataFrame:
+    """
+    Join library rows with the albums and songs already in the db.
+
+    Only the albums of the rows and their songs are loaded, in a few queries, so
+    that memory follows the number of rows rather than the size of the db.
+    Rows of albums not in the db get no "Album ID", rows of songs not in the db
+    get no "Song ID". The index of the rows is preserved.
+    """
+    index_name = rows.index.name or "index"
+    titles = rows["Album"].drop_duplicates().tolist()
+    rows = rows.reset_index().merge(db_albums(session, titles), on="Album", how="left")
+    album_ids = [int(album_id) for album_id in rows["Album ID"].dropna().unique()]
+    return rows.merge(db_songs(session, album_ids), on=SONG_KEYS, how="left").set_index(
+        index_name
+    )
+
+
+def track_duration(row: pd.Series) -> float:
+    """Return the duration in seconds of a library row, None if unknown."""
+    duration = pd.to_numeric(row.get("Total Time"), errors="coerce")
+    return None if pd.isna(duration) else duration / 1000
+
+
+def process_album(
+    group: pd.DataFrame,
+    album: Album,
+    writer: BatchWriter,
+    checkpoint: ResolutionCheckpoint = None,
+    threshold: float = None,
+) -> pd.DataFrame:
+    """Helper function to add the new songs of an album from the csv to the db."""
+    # Video IDs of the songs added, a song can be listed twice
+    added = {}
+    video_ids = {}
     for index, row in group.iterrows():
         song_title = row["Title"]
         artist = row["Artist"]
         album_title = album.title
-        genre = row["Genre"]
-        disc = int(row["Disc Number"])
-        track = int(row["Track Number"])
-        composer = row["Composer"]
-        # Could be initially empty
-        video_id = row["Video ID"]
-        artwork_url = row["Artwork URL"]
-
-        song = (
-            session.query(Song)
-            .filter_by(title=song_title, artist=artist, album=album)
-            .first()
-        )
-
-        if song:
-            updated = False
-            if video_id and (video_id != song.video_id):
-                # Update song video_id with new one from CSV
-                song.video_id = video_id
-                print(
-                    f"[+] updated video_id: [{video_id}] -> '{song_title} - {album_title} - {artist}'"
-                )
-                updated = True
-            elif not video_id:
-                # Update CSV with id stored in DB
-                group.loc[index, "Video ID"] = song.video_id
-            db_artwork = song.album.artwork_url
-            if artwork_url and (artwork_url != db_artwork):
-                song.album.artwork_url = artwork_url
-                updated = True
-            elif not artwork_url and db_artwork:
-                group.loc[index, "Artwork URL"] = db_artwork
-            if updated:
-                session.commit()
 
+        if (song_title, artist) in added:
+            video_ids[index] = added[(song_title, artist)]
             continue
 
-        # Otherwise the song has to be associated with a video_id and put in DB
-        song = Song(
-            title=song_title,
-            artist=artist,
-            album=album,
-            genre=genre,
-            disc=disc,
-            track=track,
-            composer=composer,
-            video_id=video_id,
-        )
+        # The song has to be associated with a video_id and put in DB
+        values = {
+            "title": song_title,
+            "artist": artist,
+            "genre": row["Genre"],
+            "disc": int(row["Disc Number"]),
+            "track": int(row["Track Number"]),
+            "composer": row["Composer"],
+            # Could be initially empty
+            "video_id": row["Video ID"],
+        }
+        if not values["video_id"] and checkpoint:
+            values["video_id"] = checkpoint.get(song_title, artist, album_title)
+        # Detached from the album in db so that it is only inserted by the writer
+        song = Song(**values, album=album.clone())
         try:
-            video_id = get_video_id(song)
-            group.loc[index, "Video ID"] = video_id
-
-            song.video_id = video_id
-            session.add(song)
-            session.commit()
+            video_id = get_video_id(
+                song, writer.session, threshold, track_duration(row)
+            )
+            writer.insert(Song, {**values, "video_id": video_id, "album_id": album.id})
+            video_ids[index] = added[(song_title, artist)] = video_id
+            if checkpoint:
+                checkpoint.add(song_title, artist, album_title, video_id)
 
             print(
                 f"[+] video_id: [{video_id}] -> '{song_title} - {album_title} - {artist}'"
@@ -87,69 +241,266 @@ def process_album(group: pd.DataFrame, album: Album, session: Session) -> pd.Dat
             print(f"[-] Skipping song '{song_title} - {album_title} - {artist}'")
             continue
 
+    if video_ids:
+        group.loc[list(video_ids), "Video ID"] = list(video_ids.values())
     return group
 
 
-def process_csv(filename: str, session: Session):
-    """Function to read CSV and process rows"""
-    df = pd.read_csv(filename).fillna("")
-    grouped = df.groupby("Album")
+def process_removed(removed: pd.DataFrame, session: Session):
+    """Delete from the db the songs that are no longer part of the library."""
+    if removed.empty:
+        return
+    removed = match_db(removed, session)
+    removed = removed[removed["Song ID"].notna()]
+    song_ids = [int(song_id) for song_id in removed["Song ID"]]
+    session.execute(delete(Organizer).where(Organizer.song_id.in_(song_ids)))
+    session.execute(delete(SongFile).where(SongFile.song_id.in_(song_ids)))
+    session.execute(delete(Song).where(Song.id.in_(song_ids)))
+    session.commit()
+    for _, row in removed.iterrows():
+        print(f"[-] removed: '{row['Title']} - {row['Album']} - {row['Artist']}'")
+
+
+def sync_existing_songs(df: pd.DataFrame, rows: pd.DataFrame, writer: BatchWriter):
+    """
+    Reconcile the library rows of songs already in the db, only the ones that
+    differ are written.
+
+    - a video ID or artwork URL set in the library overrides the db
+    - a video ID or artwork URL missing from the library is filled from the db
+    """
+    existing = rows["Song ID"].notna()
+
+    changed = existing & (rows["Video ID"] != "")
+    changed &= rows["Video ID"] != rows["DB Video ID"]
+    if changed.any():
+        # Update songs video_id with new ones from CSV
+        writer.execute(
+            update(Song),
+            [
+                {"id": int(song_id), "video_id": video_id}
+                for song_id, video_id in zip(
+                    rows.loc[changed, "Song ID"], rows.loc[changed, "Video ID"]
+                )
+            ],
+        )
+        for _, row in rows[changed].iterrows():
+            print(
+                f"[+] updated video_id: [{row['Video ID']}] -> '{row['Title']} - {row['Album']} - {row['Artist']}'"
+            )
+    # Update CSV with ids stored in DB
+    missing = existing & (rows["Video ID"] == "")
+    df.loc[rows.index[missing], "Video ID"] = rows.loc[missing, "DB Video ID"]
+
+    db_artwork = rows["DB Artwork URL"].fillna("")
+    changed = existing & (rows["Artwork URL"] != "")
+    changed &= rows["Artwork URL"] != db_artwork
+    artworks = (
+        rows[changed]
+        .drop_duplicates("Album ID", keep="last")
+        .set_index("Album ID")["Artwork URL"]
+    )
+    writer.execute(
+        update(Album),
+        [
+            {"id": int(album_id), "artwork_url": artwork_url}
+            for album_id, artwork_url in artworks.items()
+        ],
+    )
+    artwork = rows["Album ID"].map(artworks).fillna(db_artwork)
+    missing = existing & (rows["Artwork URL"] == "") & (artwork != "")
+    df.loc[rows.index[missing], "Artwork URL"] = artwork[missing]
+
+
+def album_windows(rows: pd.DataFrame, window: int = SEARCH_WINDOW):
+    """Group the rows of new songs by album, in lists of about window songs."""
+    groups = []
+    size = 0
+    for album_id, group in rows.groupby("Album ID"):
+        groups.append((album_id, group))
+        size += len(group)
+        if size >= window:
+            yield groups
+            groups = []
+            size = 0
+    if groups:
+        yield groups
 
-    for album_title, group in grouped:
-        album = session.query(Album).filter_by(title=album_title).first()
-        if not album:
-            album = Album(title=album_title)
 
-            # Get album info from its first available song
-            row = group.iloc[0]
-            album.tracks = int(row["Track Count"])
-            album.artist = row["Album Artist"]
-            album.release_date = row["Release Date"]
+def prefetch_album_searches(
+    groups: list, session: Session, checkpoint: ResolutionCheckpoint = None
+):
+    """Search concurrently the songs of albums that still need a video ID."""
+    queries = []
+    for _, group in groups:
+        for title, artist, album, video_id in group[
+            ["Title", "Artist", "Album", "Video ID"]
+        ].itertuples(index=False):
+            if video_id or (checkpoint and checkpoint.get(title, artist, album)):
+                continue
+            queries.append(song_query(title, artist, album))
+    searched = prefetch_search_results(queries, session)
+    if searched:
+        print(f"[=] Searched {searched} songs on YouTube Music")
 
-            artwork_url = row["Artwork URL"]
-            if artwork_url:
-                album.artwork_url = artwork_url
 
-            session.add(album)
-            session.commit()
+def process_library(
+    df: pd.DataFrame,
+    writer: BatchWriter,
+    pending: pd.Series = None,
+    checkpoint: ResolutionCheckpoint = None,
+    threshold: float = None,
+) -> pd.DataFrame:
+    """
+    Process the rows of a library DataFrame.
+
+    The songs and albums already in the db are loaded at once and joined with
+    the library, so that only new or changed rows cost a db write. Writes are
+    grouped in the transactions of the given writer, and the resolved video IDs
+    saved to the given checkpoint.
+    Only the rows selected by the pending mask are processed, if given.
+    With a threshold, YouTube Music results are matched without asking.
+    Returns: the DataFrame updated with video IDs and artwork URLs
+    """
+    rows = df if pending is None else df[pending]
+    if rows.empty:
+        return df
+
+    session = writer.session
+    rows = match_db(rows, session)
+    new_albums = rows[rows["Album ID"].isna()].drop_duplicates("Album")
+    for _, row in new_albums.iterrows():
+        album = Album(title=row["Album"])
+
+        # Get album info from its first available song
+        album.tracks = int(row["Track Count"])
+        album.artist = row["Album Artist"]
+        album.release_date = row["Release Date"]
+
+        artwork_url = row["Artwork URL"]
+        if artwork_url:
+            album.artwork_url = artwork_url
+
+        writer.add(album)
+    if len(new_albums):
+        rows = match_db(rows[df.columns], session)
+
+    sync_existing_songs(df, rows, writer)
+
+    for groups in album_windows(rows[rows["Song ID"].isna()]):
+        prefetch_album_searches(groups, session, checkpoint)
+        for album_id, group in groups:
+            album = session.get(Album, int(album_id))
+            group = process_album(
+                group[df.columns], album, writer, checkpoint, threshold
+            )
+
+            # Update original DataFrame too
+            df.loc[group.index, "Video ID"] = group["Video ID"]
 
-        group = process_album(group, album, session)
+    return df
 
-        # Update original DataFrame too
-        for index, row in group.iterrows():
-            df.at[index, "Video ID"] = row["Video ID"]
-            df.at[index, "Artwork URL"] = row["Artwork URL"]
+
+def checkpoint_path(lib_path: str) -> str:
+    """Return the path of the video IDs resolution checkpoint of a library."""
+    return os.path.splitext(lib_path)[0] + ".checkpoint.json"
+
+
+def pending_rows(df: pd.DataFrame, delta: dict) -> pd.Series:
+    """Return the mask of the rows to process given a delta, None for all rows."""
+    if delta is None:
+        return None
+    return df["Persistent ID"].isin(delta["changed"]) | (df["Video ID"] == "")
+
+
+def compact_library(chunk: pd.DataFrame) -> pd.DataFrame:
+    """Store the repetitive text columns of a library chunk as categoricals."""
+    return chunk.astype({column: "category" for column in CATEGORY_COLUMNS})
+
+
+def process_csv_chunked(
+    filename: str,
+    session: Session,
+    delta: dict = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    resume: bool = True,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    threshold: float = None,
+):
+    """
+    Process a library chunk_size rows at a time, so that memory stays bounded
+    however large the library is.
+
+    Only the columns needed for processing are read, then the library is copied
+    chunk by chunk with the updated video IDs and artwork URLs. Rows keep their
+    order, the library is not sorted again.
+    """
+    if delta is not None:
+        process_removed(delta["removed"], session)
+
+    # Only the rows whose video ID or artwork URL changed are kept
+    updates = []
+    with BatchWriter(session, batch_size) as writer, ResolutionCheckpoint(
+        checkpoint_path(filename), writer, resume
+    ) as checkpoint:
+        for chunk in iter_library_chunks(filename, chunk_size, PROCESS_COLUMNS):
+            chunk = compact_library(chunk)
+            before = chunk[UPDATED_COLUMNS].copy()
+            chunk = process_library(
+                chunk, writer, pending_rows(chunk, delta), checkpoint, threshold
+            )
+            # Songs added to the db have to be visible to the next chunks
+            writer.commit()
+            changed = (chunk[UPDATED_COLUMNS] != before).any(axis=1)
+            updates.append(chunk.loc[changed, UPDATED_COLUMNS])
+            print(f"[+] Processed {chunk.index[-1] + 1} rows")
+    updates = pd.concat(updates) if updates else pd.DataFrame(columns=UPDATED_COLUMNS)
+
+    def updated_chunks():
+        for chunk in iter_library_chunks(filename, chunk_size):
+            rows = updates.index.intersection(chunk.index)
+            chunk.loc[rows, UPDATED_COLUMNS] = updates.loc[rows]
+            yield chunk
+
+    write_library_chunks(updated_chunks(), filename)
+
+
+def process_csv(
+    filename: str,
+    session: Session,
+    delta: dict = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    resume: bool = True,
+    chunk_size: int = 0,
+    threshold: float = None,
+):
+    """
+    Function to read CSV and process rows
+
+    When a delta from an incremental parse is given, only the changed rows and
+    the rows still missing a video ID are processed.
+    When resuming, the video IDs resolved by an interrupted run are reused.
+    With a chunk_size, the library is processed chunk by chunk.
+    With a threshold, YouTube Music results are matched without asking and the
+    songs without a confident match are queued for review.
+    """
+    if chunk_size:
+        return process_csv_chunked(
+            filename, session, delta, batch_size, resume, chunk_size, threshold
+        )
+
+    df = read_library(filename)
+    pending = pending_rows(df, delta)
+    if delta is not None:
+        process_removed(delta["removed"], session)
+
+    with BatchWriter(session, batch_size) as writer, ResolutionCheckpoint(
+        checkpoint_path(filename), writer, resume
+    ) as checkpoint:
+        df = process_library(df, writer, pending, checkpoint, threshold)
 
     # Sort and keep only relevant fields
-    df = sort_library(
-        df[
-            [
-                "Title",
-                "Album",
-                "Album Artist",
-                "Video ID",
-                "Artwork URL",
-                "Artist",
-                "Composer",
-                "Genre",
-                "Release Date",
-                "Year",
-                "Explicit",
-                "Disc Count",
-                "Disc Number",
-                "Track Count",
-                "Track Number",
-                "Favorited",
-                "Loved",
-                "Playlist Only",
-                "Sort Name",
-                "Sort Album",
-                "Sort Album Artist",
-                "Sort Artist",
-                "Sort Composer",
-            ]
-        ]
-    )
+    df = sort_library(df)
 
     # Finally, export the updated CSV, with video ids
-    df.to_csv(filename, index=False)
+    write_library(df, filename)
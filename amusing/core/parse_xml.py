@@ -1,161 +1,467 @@
+import json
 import os
 import re
 import xml.etree.ElementTree as ET
+from contextlib import nullcontext
 
+import numpy as np
 import pandas as pd
 from unidecode import unidecode
 
+from amusing.utils.funcs import save_json_atomic
+
+# Hidden column caching the normalized album sort key, never exported
+SORT_KEY_COLUMN = "_sort_key"
+
+
+def normalize_sort_name(name: str) -> str:
+    """Normalize a name for sorting, names starting with a number are sorted last."""
+    decoded = unidecode(name.lower())
+    if re.match(r"\A[0-9]", decoded):
+        return "~" + decoded
+    return decoded
+
+
+def normalized_sort_column(column: pd.Series) -> pd.Series:
+    """Normalize a column for sorting, each distinct value is normalized only once."""
+    codes, uniques = pd.factorize(column.astype(str))
+    normalized = np.array([normalize_sort_name(unique) for unique in uniques])
+    return pd.Series(normalized[codes], index=column.index)
+
+
+def add_sort_key(library: pd.DataFrame) -> pd.DataFrame:
+    """Compute the hidden sort key column, unless it was already computed."""
+    if SORT_KEY_COLUMN not in library:
+        # Separator sorts before any printable character so that the album artist
+        # always takes precedence over the album
+        library = library.assign(
+            **{
+                SORT_KEY_COLUMN: normalized_sort_column(library["Sort Album Artist"])
+                + "\x01"
+                + normalized_sort_column(library["Sort Album"])
+            }
+        )
+    return library
+
 
 def sort_library(library: pd.DataFrame) -> pd.DataFrame:
-    library = library.sort_values(
-        ["Disc Number", "Track Number"],
-    )
+    """Sort the library by album artist, album, disc and track in a single pass."""
+    library = add_sort_key(library)
     return library.sort_values(
-        ["Sort Album Artist", "Sort Album"],
-        key=lambda col: col.str.lower().map(
-            lambda it: (
-                # Force numbers to be sorted last
-                lambda decoded: "~" + decoded
-                if re.match(r"\A[0-9]", decoded)
-                else decoded
-            )(unidecode(it))
-        ),
+        [SORT_KEY_COLUMN, "Disc Number", "Track Number"],
+        key=lambda col: col
+        if col.name == SORT_KEY_COLUMN
+        else pd.to_numeric(col, errors="coerce"),
+        kind="stable",
     )
 
 
-def parse_library_xml(root_download_path: str, lib_path: str):
-    try:
-        tree = ET.parse(lib_path)
-        root = tree.getroot()
-        main_dict = root.findall("dict")
-        for item in list(main_dict[0]):
-            if item.tag == "dict":
-                tracks_dict = item
-                break
-        tracklist = list(tracks_dict.findall("dict"))
-        print(f"Total tracklist length: {len(tracklist)}")
-
-        podcast = []
-        purchased = []
-        apple_music = []
-        for item in tracklist:
-            x = list(item)
-            for i in range(len(x)):
-                if x[i].text == "Genre" and x[i + 1].text == "Podcast":  #
-                    podcast.append(list(item))
-                if x[i].text == "Kind" and x[i + 1].text == "Purchased AAC audio file":
-                    purchased.append(list(item))
-                if (
-                    x[i].text == "Kind"
-                    and x[i + 1].text == "Apple Music AAC audio file"
-                ):
-                    apple_music.append(list(item))
-        print(f"Total apple music library length: {len(apple_music)}")
-
-        def cols(kind):
-            cols = []
-            for i in range(len(kind)):
-                for j in range(len(kind[i])):
-                    if kind[i][j].tag == "key":
-                        cols.append(kind[i][j].text)
-            return set(cols)
-
-        podcast_cols = cols(podcast)
-        purchased_cols = cols(purchased)
-        apple_music_cols = cols(apple_music)
-
-        def df_creation(kind, cols):
-            df = pd.DataFrame(columns=cols)
-            for i in range(len(kind)):
-                dict1 = {}
-                for j in range(len(kind[i])):
-                    if kind[i][j].tag == "key":
-                        if kind[i][j + 1].tag == "true":
-                            dict1[kind[i][j].text] = True
-                        elif kind[i][j + 1].tag == "false":
-                            dict1[kind[i][j].text] = False
-                        else:
-                            dict1[kind[i][j].text] = kind[i][j + 1].text
-                list_values = [i for i in dict1.values()]
-                list_keys = [j for j in dict1.keys()]
-                df_temp = pd.DataFrame([list_values], columns=list_keys)
-                df = pd.concat([df, df_temp], axis=0, ignore_index=True, sort=True)
-            return df
-
-        df_apple_music = df_creation(apple_music, list(apple_music_cols))
-        if not "Sort Album Artist" in df_apple_music:
-            df_apple_music.insert(0, "Sort Album Artist", "")
-        if not "Sort Composer" in df_apple_music:
-            df_apple_music.insert(0, "Sort Composer", "")
-
-        # Fill empty boolean fields
-        df_apple_music = df_apple_music.fillna(
-            {
-                "Apple Music": False,
-                "Compilation": False,
-                "Explicit": False,
-                "Favorited": False,
-                "Loved": False,
-                "Part Of Gapless Album": False,
-                "Playlist Only": False,
-            }
+# Columns kept in the parsed Library.csv, in order
+LIBRARY_COLUMNS = [
+    "Title",
+    "Album",
+    "Album Artist",
+    "Video ID",
+    "Artwork URL",
+    "Artist",
+    "Composer",
+    "Genre",
+    "Release Date",
+    "Year",
+    "Explicit",
+    "Disc Count",
+    "Disc Number",
+    "Track Count",
+    "Track Number",
+    "Total Time",
+    "Favorited",
+    "Loved",
+    "Playlist Only",
+    "Sort Name",
+    "Sort Album",
+    "Sort Album Artist",
+    "Sort Artist",
+    "Sort Composer",
+    "Persistent ID",
+]
+LIBRARY_INT_COLUMNS = [
+    "Year",
+    "Disc Count",
+    "Disc Number",
+    "Track Count",
+    "Track Number",
+    "Total Time",
+]
+LIBRARY_BOOL_COLUMNS = ["Explicit", "Favorited", "Loved", "Playlist Only"]
+
+# The columnar library snapshot requires the optional pyarrow package
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    HAS_PARQUET = True
+except ImportError:
+    HAS_PARQUET = False
+
+# Fields read from each track of the Library.xml, "Name" becomes the "Title" column
+XML_TRACK_FIELDS = ["Name"] + [
+    column
+    for column in LIBRARY_COLUMNS
+    if column not in ("Title", "Video ID", "Artwork URL")
+]
+
+APPLE_MUSIC_KIND = "Apple Music AAC audio file"
+
+# Persistent ID -> Date Modified of every track seen by the last parse
+MANIFEST_FILENAME = "Library.manifest.json"
+
+
+def track_record(track: ET.Element) -> dict:
+    """Convert a track <dict> element of the Library.xml into a plain dict."""
+    record = {}
+    children = list(track)
+    for key, value in zip(children[::2], children[1::2]):
+        if value.tag == "true":
+            record[key.text] = True
+        elif value.tag == "false":
+            record[key.text] = False
+        else:
+            record[key.text] = value.text
+    return record
+
+
+def iter_library_tracks(lib_path: str):
+    """
+    Stream the tracks of a Library.xml file one at a time.
+
+    Elements are discarded as soon as they are consumed so memory stays flat
+    regardless of the size of the library.
+    """
+    # Elements currently open: plist > dict > (Tracks) dict > track dict > field
+    stack = []
+    top_key = None
+    for event, elem in ET.iterparse(lib_path, events=("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            continue
+
+        stack.pop()
+        level = len(stack)
+        if level == 2:
+            if elem.tag == "key":
+                top_key = elem.text
+            else:
+                # Done with a top level value ("Tracks", "Playlists", ...)
+                stack[-1].clear()
+        elif level == 3:
+            if top_key == "Tracks" and elem.tag == "dict":
+                yield track_record(elem)
+            if elem.tag != "key":
+                stack[-1].clear()
+
+
+def load_manifest(manifest_path: str) -> dict:
+    """Load the tracks manifest written by a previous parse, if any."""
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r") as file:
+        return json.load(file)
+
+
+def save_manifest(manifest_path: str, manifest: dict):
+    """Atomically write the tracks manifest."""
+    save_json_atomic(manifest_path, manifest)
+
+
+# Text columns are read as such, a title like "1989" must not become a number
+LIBRARY_TEXT_DTYPES = {
+    column: str
+    for column in LIBRARY_COLUMNS
+    if column not in LIBRARY_INT_COLUMNS + LIBRARY_BOOL_COLUMNS
+}
+
+
+def read_library_csv(lib_path: str) -> pd.DataFrame:
+    """Read a Library.csv, making sure all the library columns are present."""
+    return (
+        pd.read_csv(lib_path, dtype=LIBRARY_TEXT_DTYPES)
+        .reindex(columns=LIBRARY_COLUMNS)
+        .fillna("")
+    )
+
+
+def library_snapshot_path(lib_path: str) -> str:
+    """Return the path of the columnar snapshot kept alongside a Library.csv."""
+    return os.path.splitext(lib_path)[0] + ".parquet"
+
+
+def library_exists(lib_path: str) -> bool:
+    """Whether a Library.csv or its columnar snapshot exists."""
+    return os.path.exists(lib_path) or (
+        HAS_PARQUET and os.path.exists(library_snapshot_path(lib_path))
+    )
+
+
+def typed_library(library: pd.DataFrame) -> pd.DataFrame:
+    """Cast the library columns to the types of the columnar snapshot."""
+    library = library[LIBRARY_COLUMNS].copy()
+    for column in LIBRARY_COLUMNS:
+        if column in LIBRARY_INT_COLUMNS:
+            library[column] = pd.to_numeric(library[column], errors="coerce").astype(
+                "Int64"
+            )
+        elif column in LIBRARY_BOOL_COLUMNS:
+            library[column] = library[column].astype(str) == "True"
+        else:
+            library[column] = library[column].astype(str)
+    return library
+
+
+def snapshot_is_fresh(lib_path: str) -> bool:
+    """
+    Whether the columnar snapshot of a library can be used, that is when it is
+    at least as recent as the Library.csv, which can be edited by hand.
+    """
+    snapshot_path = library_snapshot_path(lib_path)
+    return (
+        HAS_PARQUET
+        and os.path.exists(snapshot_path)
+        and (
+            not os.path.exists(lib_path)
+            or os.path.getmtime(snapshot_path) >= os.path.getmtime(lib_path)
         )
+    )
 
-        # Fill empty sorting fields
-        df_apple_music = df_apple_music.fillna("")
-        for i in range(len(df_apple_music)):
-            if not df_apple_music.loc[i, "Sort Album Artist"]:
-                df_apple_music.loc[i, "Sort Album Artist"] = df_apple_music.loc[
-                    i, "Album Artist"
-                ]
-            if not df_apple_music.loc[i, "Sort Composer"]:
-                df_apple_music.loc[i, "Sort Composer"] = df_apple_music.loc[
-                    i, "Composer"
-                ]
-
-        # Move title column at the beginning
-        title_column = df_apple_music.pop("Name")
-        df_apple_music.insert(0, "Title", title_column)
-        # Add album artwork column
-        df_apple_music.insert(3, "Artwork URL", "")
-        # Add video id column
-        df_apple_music.insert(3, "Video ID", "")
 
-        print("Dataframe created of length: ", len(df_apple_music))
+def snapshot_columns(snapshot, columns: list) -> list:
+    """Return the given columns present in a snapshot, older ones may lack some."""
+    return [column for column in columns if column in snapshot.schema_arrow.names]
 
-        # Sort and keep only relevant fields
-        df_apple_music = sort_library(
-            df_apple_music[
-                [
-                    "Title",
-                    "Album",
-                    "Album Artist",
-                    "Video ID",
-                    "Artwork URL",
-                    "Artist",
-                    "Composer",
-                    "Genre",
-                    "Release Date",
-                    "Year",
-                    "Explicit",
-                    "Disc Count",
-                    "Disc Number",
-                    "Track Count",
-                    "Track Number",
-                    "Favorited",
-                    "Loved",
-                    "Playlist Only",
-                    "Sort Name",
-                    "Sort Album",
-                    "Sort Album Artist",
-                    "Sort Artist",
-                    "Sort Composer",
-                ]
-            ]
+
+def read_library(lib_path: str, columns: list = None) -> pd.DataFrame:
+    """Read a library, only the given columns if any, from its snapshot if fresh."""
+    if snapshot_is_fresh(lib_path):
+        snapshot = pq.ParquetFile(library_snapshot_path(lib_path))
+        columns = columns or LIBRARY_COLUMNS
+        return (
+            snapshot.read(columns=snapshot_columns(snapshot, columns))
+            .to_pandas()
+            .reindex(columns=columns)
+        )
+
+    library = read_library_csv(lib_path)
+    return library if columns is None else library[columns]
+
+
+def iter_library_chunks(lib_path: str, chunk_size: int, columns: list = None):
+    """
+    Read a library chunk_size rows at a time, only the given columns if any.
+
+    Chunks are indexed by their row numbers in the whole library.
+    """
+    columns = columns or LIBRARY_COLUMNS
+    if snapshot_is_fresh(lib_path):
+        start = 0
+        snapshot = pq.ParquetFile(library_snapshot_path(lib_path))
+        for batch in snapshot.iter_batches(
+            batch_size=chunk_size, columns=snapshot_columns(snapshot, columns)
+        ):
+            chunk = batch.to_pandas().reindex(columns=columns)
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
+            yield chunk
+        return
+
+    for chunk in pd.read_csv(
+        lib_path,
+        usecols=lambda column: column in columns,
+        dtype=LIBRARY_TEXT_DTYPES,
+        chunksize=chunk_size,
+    ):
+        yield chunk.reindex(columns=columns).fillna("")
+
+
+def write_library(library: pd.DataFrame, lib_path: str, export_csv: bool = True):
+    """Write a library to its columnar snapshot and, if export_csv, to lib_path."""
+    if export_csv:
+        library[LIBRARY_COLUMNS].to_csv(lib_path, index=False)
+    if HAS_PARQUET:
+        # Written last so that it is never older than the CSV it was made with
+        typed_library(library).to_parquet(
+            library_snapshot_path(lib_path), index=False, compression="zstd"
+        )
+
+
+def library_dataframe(tracks: list) -> pd.DataFrame:
+    """Build the library DataFrame from track records in a single columnar step."""
+    df_apple_music = pd.DataFrame.from_records(tracks, columns=XML_TRACK_FIELDS)
+
+    # Fill empty boolean fields
+    df_apple_music = df_apple_music.fillna(
+        {
+            "Explicit": False,
+            "Favorited": False,
+            "Loved": False,
+            "Playlist Only": False,
+        }
+    )
+
+    # Fill empty sorting fields
+    df_apple_music = df_apple_music.fillna("")
+    for sort_column, column in [
+        ("Sort Album Artist", "Album Artist"),
+        ("Sort Composer", "Composer"),
+    ]:
+        df_apple_music[sort_column] = df_apple_music[sort_column].mask(
+            df_apple_music[sort_column] == "", df_apple_music[column]
         )
-        df_apple_music.to_csv(
-            os.path.join(root_download_path, "Library.csv"), index=False
+
+    # Move title column at the beginning
+    title_column = df_apple_music.pop("Name")
+    df_apple_music.insert(0, "Title", title_column)
+    # Add album artwork column
+    df_apple_music.insert(3, "Artwork URL", "")
+    # Add video id column
+    df_apple_music.insert(3, "Video ID", "")
+
+    return df_apple_music
+
+
+def iter_changed_tracks(lib_path: str, previous: dict, manifest: dict):
+    """
+    Stream the Apple Music tracks added or modified since the previous manifest.
+
+    The manifest dict is filled with every Apple Music track seen along the way.
+    """
+    total = 0
+    for track in iter_library_tracks(lib_path):
+        total += 1
+        if track.get("Kind") != APPLE_MUSIC_KIND:
+            continue
+        persistent_id = track.get("Persistent ID")
+        date_modified = track.get("Date Modified")
+        manifest[persistent_id] = date_modified
+        if persistent_id not in previous or previous[persistent_id] != date_modified:
+            yield {field: track.get(field) for field in XML_TRACK_FIELDS}
+    print(f"Total tracklist length: {total}")
+    print(f"Total apple music library length: {len(manifest)}")
+
+
+def iter_library_batches(tracks, batch_size: int):
+    """Group track records into library DataFrames of at most batch_size rows."""
+    batch = []
+    for track in tracks:
+        batch.append(track)
+        if len(batch) >= batch_size:
+            yield library_dataframe(batch)
+            batch = []
+    if batch:
+        yield library_dataframe(batch)
+
+
+def merge_library(existing: pd.DataFrame, changes: pd.DataFrame, removed_ids: set):
+    """
+    Merge the changed rows into an existing library.
+
+    Returns: (merged library, rows of the existing library removed or renamed)
+    """
+    changed = set(changes["Persistent ID"])
+    outdated = existing["Persistent ID"].isin(changed | removed_ids)
+
+    # Previous versions of the songs that were removed or renamed
+    keys = ["Title", "Artist", "Album"]
+    removed = existing[outdated].merge(
+        changes[keys].drop_duplicates(), on=keys, how="left", indicator=True
+    )
+    removed = removed[removed["_merge"] == "left_only"].drop(columns="_merge")
+
+    merged = pd.concat([existing[~outdated], changes], ignore_index=True)
+    return merged, removed
+
+
+def print_library_changes(changed: set, previous: dict, manifest: dict):
+    """Summarize the tracks added, modified and removed since the previous parse."""
+    added = len(changed - previous.keys())
+    removed = len(previous.keys() - manifest.keys())
+    print(
+        f"Library changes: {added} added, {len(changed) - added} modified, {removed} removed"
+    )
+
+
+def parse_library_xml(root_download_path: str, lib_path: str, incremental: bool = True):
+    """
+    Parse the Library.xml into root_download_path/Library.csv.
+
+    When incremental and a previous parse is found, only the tracks added or
+    modified since then are read, and merged into the existing Library.csv.
+
+    Returns: (delta, manifest, error)
+    - delta is None for a full parse, otherwise a dict with the "changed"
+      Persistent IDs and the "removed" rows of the previous Library.csv
+    - manifest is the tracks manifest of the Library.xml, to be saved with
+      save_manifest once the Library.csv is processed, so that the tracks of an
+      interrupted run are part of the next delta
+    """
+    try:
+        library_path = os.path.join(root_download_path, "Library.csv")
+        manifest_path = os.path.join(root_download_path, MANIFEST_FILENAME)
+        previous = {}
+        if incremental and library_exists(library_path):
+            previous = load_manifest(manifest_path)
+
+        manifest = {}
+        df_apple_music = library_dataframe(
+            list(iter_changed_tracks(lib_path, previous, manifest))
         )
+        delta = None
+        if previous:
+            changed = set(df_apple_music["Persistent ID"])
+            print_library_changes(changed, previous, manifest)
+            df_apple_music, removed = merge_library(
+                read_library(library_path),
+                df_apple_music,
+                previous.keys() - manifest.keys(),
+            )
+            delta = {"changed": changed, "removed": removed}
+
+        print("Dataframe created of length: ", len(df_apple_music))
+
+        # Sort and keep only relevant fields
+        df_apple_music = sort_library(df_apple_music)
+        write_library(df_apple_music, library_path)
+        return delta, manifest, 0
     except Exception as e:
         print("Something went wrong in parsing your Library XML file: ", e)
-        return 1
+        return None, None, 1
+
+
+def write_library_chunks(chunks, lib_path: str, export_csv: bool = True):
+    """
+    Write a library given as DataFrame chunks to its columnar snapshot and, if
+    export_csv, to lib_path, without ever holding the whole library in memory.
+    """
+    temp_path = f"{lib_path}.tmp"
+    snapshot_path = library_snapshot_path(lib_path)
+    snapshot_writer = None
+    with open(temp_path, "w", newline="") if export_csv else nullcontext() as file:
+        header = True
+        for chunk in chunks:
+            if file:
+                chunk[LIBRARY_COLUMNS].to_csv(file, index=False, header=header)
+            header = False
+            if HAS_PARQUET:
+                table = pa.Table.from_pandas(typed_library(chunk), preserve_index=False)
+                if snapshot_writer is None:
+                    snapshot_writer = pq.ParquetWriter(
+                        f"{snapshot_path}.tmp", table.schema, compression="zstd"
+                    )
+                snapshot_writer.write_table(table)
+        if file and header:
+            pd.DataFrame(columns=LIBRARY_COLUMNS).to_csv(file, index=False)
+
+    if export_csv:
+        os.replace(temp_path, lib_path)
+    if snapshot_writer:
+        snapshot_writer.close()
+        # Replaced last so that it is never older than the CSV it was made with
+        os.replace(f"{snapshot_path}.tmp", snapshot_path)
@@ -0,0 +1,236 @@
+import errno
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Full, Queue
+
+from sqlalchemy.orm import Session
+
+from amusing.core.download import (
+    DownloadJob,
+    close_song_downloader,
+    fetch_song_audio,
+    generate_song_file,
+    prepare_album_artwork,
+    prepare_download,
+    recorded_file_unchanged,
+)
+from amusing.core.save_to_db import record_song_file
+
+# Number of songs downloaded from YouTube at once
+DEFAULT_DOWNLOAD_WORKERS = 4
+# Number of album artworks downloaded at once
+DEFAULT_ARTWORK_WORKERS = 2
+# Number of song files tagged at once
+DEFAULT_TAG_WORKERS = os.cpu_count() or 2
+# Seconds waited for room in a queue before checking that its stage is still running
+QUEUE_TIMEOUT = 1
+
+
+def ffmpeg_missing(error: Exception) -> bool:
+    """Return whether an error comes from FFmpeg not being installed."""
+    return isinstance(error, FileNotFoundError) and error.filename == "ffmpeg"
+
+
+class DownloadPipeline:
+    """
+    Download songs through three stages running concurrently, each with its own
+    number of workers:
+
+    - the audio of the songs is downloaded from YouTube by download workers
+    - the distinct artworks of the albums are downloaded and converted once,
+      all ahead, by artwork workers
+    - the song files are generated and tagged by tag workers, once both the
+      audio and the artwork of a song are there
+
+    Stages are linked by queues holding at most queue_size songs, so that a
+    stage waits when the next one is behind instead of piling up work.
+    A song whose download or tagging fails is skipped, the pipeline only stops
+    when FFmpeg is not installed.
+
+    Given a db session, whether a song file is up to date is told from the files
+    inventory, loaded once, and the generated files are recorded in it by the
+    calling thread, committed at the end.
+    """
+
+    def __init__(
+        self,
+        root_download_path: str,
+        overwrite: bool = False,
+        download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+        artwork_workers: int = DEFAULT_ARTWORK_WORKERS,
+        tag_workers: int = DEFAULT_TAG_WORKERS,
+        queue_size: int = None,
+        session: Session = None,
+        song_files: dict = None,
+    ):
+        self.root_download_path = root_download_path
+        self.overwrite = overwrite
+        self.download_workers = download_workers
+        self.artwork_workers = artwork_workers
+        self.tag_workers = tag_workers
+        queue_size = queue_size or 2 * max(download_workers, tag_workers)
+        self.download_queue = Queue(maxsize=queue_size)
+        self.tag_queue = Queue(maxsize=queue_size)
+        self.done_queue = Queue()
+        self.session = session
+        self.song_files = song_files if song_files is not None else {}
+        self.artworks = {}
+        self.download_threads = []
+        self.tag_threads = []
+        self.stopped = threading.Event()
+        self.error = None
+
+    def stop(self, error: Exception):
+        """Stop the pipeline, as no song can be generated."""
+        self.error = error
+        self.stopped.set()
+
+    def prefetch_artworks(self, executor: ThreadPoolExecutor, jobs: list):
+        """Download the distinct artworks of the songs ahead, once per artwork URL."""
+        for job in jobs:
+            artwork_url = job.song.album.artwork_url
+            if not artwork_url:
+                continue
+            if artwork_url not in self.artworks:
+                self.artworks[artwork_url] = executor.submit(
+                    prepare_album_artwork, artwork_url
+                )
+            job.artwork = self.artworks[artwork_url]
+
+    def put(self, queue: Queue, item, threads: list) -> bool:
+        """
+        Put an item in the queue of a stage, waiting for room as long as the
+        threads of the stage are running.
+        Returns: whether the item was put
+        """
+        while any(thread.is_alive() for thread in threads):
+            try:
+                queue.put(item, timeout=QUEUE_TIMEOUT)
+                return True
+            except Full:
+                continue
+        return False
+
+    def skip(self, error: Exception):
+        """Skip the song of a job that failed, or stop the pipeline without FFmpeg."""
+        if ffmpeg_missing(error):
+            self.stop(error)
+            return
+        print(f"[!] Error: {error}")
+        print("[!] Something went wrong while downloading. Skipping song.")
+
+    def download_worker(self):
+        try:
+            while (job := self.download_queue.get()) is not None:
+                if self.stopped.is_set():
+                    continue
+                try:
+                    if not job.retag_path:
+                        fetch_song_audio(job)
+                except Exception as e:
+                    self.skip(e)
+                    continue
+                self.put(self.tag_queue, job, self.tag_threads)
+        finally:
+            close_song_downloader()
+
+    def tag_worker(self):
+        while (job := self.tag_queue.get()) is not None:
+            if self.stopped.is_set():
+                continue
+            try:
+                if job.artwork is not None:
+                    job.artwork.result()
+                generate_song_file(job)
+                self.done_queue.put(job.file_record())
+            except Exception as e:
+                self.skip(e)
+
+    def record_done(self):
+        """
+        Record the song files generated so far in the files inventory.
+
+        Records are committed once the workers are done: a commit expires the
+        songs, which the workers would then load again from their own threads.
+        Song files left unrecorded are recorded by the next run.
+        """
+        if self.session is None:
+            return
+        while True:
+            try:
+                record = self.done_queue.get_nowait()
+            except Empty:
+                break
+            record_song_file(record, self.song_files, self.session)
+
+    def prepare(self, songs) -> list:
+        """Return the download jobs of the songs whose file is not up to date."""
+        jobs = []
+        for song in songs:
+            # Load what the workers need while in the calling thread
+            song.album
+            record = self.song_files.get(song.id)
+            job = prepare_download(
+                song, self.root_download_path, self.overwrite, record
+            )
+            if job is not None:
+                jobs.append(job)
+            elif self.session is not None and (
+                record is None or not recorded_file_unchanged(record)
+            ):
+                # Song file generated before the files inventory, or changed since
+                record_song_file(
+                    DownloadJob(song, self.root_download_path).file_record(),
+                    self.song_files,
+                    self.session,
+                )
+        return jobs
+
+    def run(self, songs) -> Exception:
+        """
+        Download songs, given in the order they should be downloaded.
+
+        Songs are read from the calling thread only, so that they can be loaded
+        lazily from a db session. Their jobs are all prepared first, so that the
+        artworks they need are downloaded at once.
+        Returns: the error that stopped the pipeline, if any
+        """
+        if shutil.which("ffmpeg") is None:
+            return FileNotFoundError(errno.ENOENT, "FFmpeg not found", "ffmpeg")
+        jobs = self.prepare(songs)
+        self.download_threads = [
+            threading.Thread(target=self.download_worker)
+            for _ in range(self.download_workers)
+        ]
+        self.tag_threads = [
+            threading.Thread(target=self.tag_worker) for _ in range(self.tag_workers)
+        ]
+        for thread in self.download_threads + self.tag_threads:
+            thread.start()
+
+        with ThreadPoolExecutor(self.artwork_workers) as artwork_executor:
+            try:
+                self.prefetch_artworks(artwork_executor, jobs)
+                for job in jobs:
+                    if self.stopped.is_set() or not self.put(
+                        self.download_queue, job, self.download_threads
+                    ):
+                        break
+                    self.record_done()
+            finally:
+                for _ in self.download_threads:
+                    self.put(self.download_queue, None, self.download_threads)
+                for thread in self.download_threads:
+                    thread.join()
+                for _ in self.tag_threads:
+                    self.put(self.tag_queue, None, self.tag_threads)
+                for thread in self.tag_threads:
+                    thread.join()
+                for artwork in self.artworks.values():
+                    artwork.cancel()
+                self.record_done()
+                if self.session is not None:
+                    self.session.commit()
+        return self.error
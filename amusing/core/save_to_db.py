@@ -1,6 +1,9 @@
+import time
+
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 
-from amusing.db.models import Album, Song
+from amusing.db.models import Album, Song, SongFile
 
 
 def create_new_album_if_not_present(album_name: str, session: Session):
@@ -37,3 +40,115 @@ def check_if_song_in_db(
     except Exception as e:
         print(f"Exception {e} when creating the song.")
         return None, 1
+
+
+# Number of rows written to the db per transaction
+DEFAULT_BATCH_SIZE = 500
+
+
+class BatchWriter:
+    """
+    Group db writes into transactions of batch_size rows.
+
+    Queued rows are inserted with one statement per batch. Should it fail, the
+    rows of the batch are inserted again one by one within savepoints, so that
+    a bad row is left out alone instead of taking the rest of the batch with it.
+    """
+
+    def __init__(self, session: Session, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.session = session
+        self.batch_size = batch_size
+        self.inserts = {}
+        self.pending = 0
+        self.written = 0
+        self.failed = 0
+        self.start = time.perf_counter()
+
+    def add(self, instance) -> bool:
+        """Add an instance within a savepoint, returns whether it succeeded."""
+        try:
+            with self.session.begin_nested():
+                self.session.add(instance)
+        except Exception as e:
+            print(f"[!] Error: {e}")
+            self.failed += 1
+            return False
+        self.written += 1
+        self._pending(1)
+        return True
+
+    def insert(self, model, values: dict):
+        """Queue a row of the given model to be inserted with the current batch."""
+        self.inserts.setdefault(model, []).append(values)
+        self._pending(1)
+
+    def execute(self, statement, parameters: list):
+        """Execute a bulk statement, such as an UPDATE, as part of the current batch."""
+        if not parameters:
+            return
+        self.session.execute(statement, parameters)
+        self.written += len(parameters)
+        self._pending(len(parameters))
+
+    def _pending(self, rows: int):
+        self.pending += rows
+        if self.pending >= self.batch_size:
+            self.commit()
+
+    def _insert_all(self, model, rows: list):
+        try:
+            with self.session.begin_nested():
+                self.session.execute(insert(model), rows)
+            self.written += len(rows)
+            return
+        except Exception:
+            pass
+        for row in rows:
+            try:
+                with self.session.begin_nested():
+                    self.session.execute(insert(model), [row])
+                self.written += 1
+            except Exception as e:
+                print(f"[!] Error: {e}")
+                self.failed += 1
+
+    def commit(self):
+        """Insert the queued rows and commit the current batch."""
+        for model, rows in self.inserts.items():
+            self._insert_all(model, rows)
+        self.inserts = {}
+        self.session.commit()
+        self.pending = 0
+
+    def report(self):
+        """Print the number of rows written and the write throughput."""
+        elapsed = time.perf_counter() - self.start
+        rate = self.written / elapsed if elapsed else 0
+        failed = f", {self.failed} failed" if self.failed else ""
+        print(
+            f"[+] Wrote {self.written} rows to the db in {elapsed:.1f}s ({rate:.0f} rows/s){failed}"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.commit()
+        self.report()
+
+
+def load_song_files(session: Session) -> dict:
+    """Load the whole files inventory with one query, by song ID."""
+    return {song_file.song_id: song_file for song_file in session.query(SongFile)}
+
+
+def record_song_file(record: dict, song_files: dict, session: Session):
+    """Add or update the inventory record of a generated song file."""
+    song_file = song_files.get(record["song_id"])
+    if song_file is None:
+        song_file = SongFile(**record)
+        song_files[record["song_id"]] = song_file
+        session.add(song_file)
+        return
+    for key, value in record.items():
+        setattr(song_file, key, value)
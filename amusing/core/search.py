@@ -1,49 +1,226 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import typer
-from ytmusicapi import YTMusic
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
 
-from amusing.db.models import Song
+from amusing.core.match import (
+    DEFAULT_MATCH_THRESHOLD,
+    queue_for_review,
+    rank_results,
+    reviewed_item,
+)
+from amusing.core.ytmusic_client import get_ytmusic_client
+from amusing.db.models import SearchCache, Song
 
+# Seconds a cached search stays valid
+SEARCH_CACHE_TTL = 30 * 24 * 60 * 60
+# Number of searches kept in the cache, the least recently used go first
+SEARCH_CACHE_SIZE = 10000
 
-def search(song: Song) -> Song:
-    """Search song on YouTube Music and return the first result."""
-    ytmusic = YTMusic()
-    search_results = ytmusic.search(
-        f"{song.title} - {song.artist} - {song.album.title}",
-        limit=5,
-        ignore_spelling=True,
-        filter="songs",
-    )
 
-    if not len(search_results):
-        raise RuntimeError(
-            f"song not found on YouTube Music: {song.title} - {song.album} - {song.artist}"
+def normalize_query(query: str) -> str:
+    """Normalize a search query so that the same search is cached once."""
+    return " ".join(query.casefold().split())
+
+
+def cached_search_results(query: str, session: Session) -> list:
+    """Return the cached results of a search query, None if missing or expired."""
+    entry = session.get(SearchCache, query)
+    if entry is None:
+        return None
+    now = time.time()
+    if now - entry.created_at > SEARCH_CACHE_TTL:
+        session.delete(entry)
+        return None
+    entry.accessed_at = now
+    return json.loads(entry.results)
+
+
+def cache_search_results(query: str, results: list, session: Session):
+    """Cache the results of a search query and evict the least recently used ones."""
+    now = time.time()
+    session.merge(
+        SearchCache(
+            query=query, results=json.dumps(results), created_at=now, accessed_at=now
         )
+    )
+    session.flush()
+    evicted = (
+        select(SearchCache.query)
+        .order_by(SearchCache.accessed_at.desc())
+        .offset(SEARCH_CACHE_SIZE)
+    )
+    session.execute(
+        delete(SearchCache).where(SearchCache.query.in_(evicted)),
+        execution_options={"synchronize_session": False},
+    )
 
-    typer.echo("Youtube Music search results found, choose one:")
+
+def song_query(title: str, artist: str, album: str) -> str:
+    """Return the YouTube Music search query of a song."""
+    return f"{title} - {artist} - {album}"
+
+
+def fetch_search_results(query: str) -> list:
+    """Search a query on YouTube Music, without going through the cache."""
+    return get_ytmusic_client().search(
+        query, limit=5, ignore_spelling=True, filter="songs"
+    )
+
+
+def prefetch_search_results(queries: list, session: Session) -> int:
+    """
+    Search concurrently the queries missing from the search cache, and cache their
+    results so that the searches that follow do not wait on YouTube Music.
+
+    As many searches as the YouTube Music client has connections run at once,
+    within its rate limit. Results are cached from the calling thread only.
+    Returns: the number of queries searched
+    """
+    missing = {}
+    for query in queries:
+        key = normalize_query(query)
+        if key not in missing and cached_search_results(key, session) is None:
+            missing[key] = query
+    if not missing:
+        return 0
+
+    with ThreadPoolExecutor(get_ytmusic_client().pool_size) as executor:
+        futures = {
+            executor.submit(fetch_search_results, query): key
+            for key, query in missing.items()
+        }
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                # The search is tried again when the song is resolved
+                print(f"[!] Error: {e}")
+                continue
+            if results:
+                cache_search_results(futures[future], results, session)
+    return len(missing)
+
+
+def search_songs(query: str, session: Session = None) -> list:
+    """
+    Search a query on YouTube Music, through the search cache of the db if a
+    session is given.
+    """
+    key = normalize_query(query)
+    if session is not None:
+        results = cached_search_results(key, session)
+        if results is not None:
+            return results
+
+    results = fetch_search_results(query)
+    # Empty results are not cached, the song may only be missing for a while
+    if session is not None and results:
+        cache_search_results(key, results, session)
+    return results
+
+
+def choose_result(search_results: list, skip: bool = False) -> dict:
+    """
+    Prompt the user to choose one of the YouTube Music results, or to enter a video
+    ID. Returns None if skip is allowed and chosen.
+    """
     choices = [
         f"{search_result.get('title', 'Unknown title')} - {search_result.get('videoId')}"
         for search_result in search_results[:5]
     ] + ["Enter a YT Music video ID"]
+    if skip:
+        choices.append("Skip this song")
     for idx, choice in enumerate(choices, start=1):
         typer.echo(f"{idx}. {choice}")
     # Prompt user for a choice of YT Music video ID
     selected_choice = typer.prompt("Enter the option of your choice", type=int)
-    if selected_choice == len(choices):
+    if skip and selected_choice == len(choices):
+        return None
+    if selected_choice == len(choices) - skip:
         song_video_id = typer.prompt("Enter the Youtube Music Video ID: ")
         # enter a video ID manually
-        song_result = ytmusic.get_song(song_video_id)["videoDetails"]
-    elif 1 <= selected_choice < len(choices):
+        return get_ytmusic_client().get_song(song_video_id)["videoDetails"]
+    elif 1 <= selected_choice < len(choices) - skip:
         # select a video ID from the options
-        song_result = search_results[selected_choice - 1]
+        return search_results[selected_choice - 1]
     else:
         raise RuntimeError(
             "Something went wrong when trying to traverse through YouTube Music results."
         )
+
+
+def song_from_result(song: Song, song_result: dict) -> Song:
+    """Return a copy of a song with the details of a YouTube Music result."""
     result = song.clone()
     result.title = song_result["title"]
     if "artists" in song_result:
         result.artist = ", ".join(artist["name"] for artist in song_result["artists"])
     result.video_id = song_result["videoId"]
-    if "album" in song_result:
+    if song_result.get("album"):
         result.album.title = song_result["album"]["name"]
     return result
+
+
+def auto_match(
+    song: Song,
+    search_results: list,
+    session: Session = None,
+    threshold: float = DEFAULT_MATCH_THRESHOLD,
+    duration: float = None,
+) -> Song:
+    """
+    Return the best scored YouTube Music result of a song, if its score reaches the
+    threshold. Otherwise the song is queued for review in the db of the session.
+    """
+    ranked = rank_results(song, search_results, duration)
+    if ranked[0][0] >= threshold:
+        return song_from_result(song, ranked[0][1])
+
+    if session is not None:
+        queue_for_review(song, ranked, session)
+    raise RuntimeError(
+        f"no confident match on YouTube Music (best score {ranked[0][0]:.2f}), queued for review: {song.title} - {song.album.title} - {song.artist}"
+    )
+
+
+def search(
+    song: Song,
+    session: Session = None,
+    threshold: float = None,
+    duration: float = None,
+) -> Song:
+    """
+    Search song on YouTube Music and return the first result.
+
+    Results are cached in the db of the given session, so that a song searched
+    again is not sent to YouTube Music.
+    With a threshold, the best scored result is chosen without asking the user
+    when its score reaches it, see auto_match. The duration of the song in
+    seconds helps scoring if known.
+    """
+    if session is not None:
+        item = reviewed_item(song, session)
+        if item is not None and item.video_id:
+            # A video ID was already chosen for the song when reviewing it
+            return song_from_result(
+                song, {"title": song.title, "videoId": item.video_id}
+            )
+
+    search_results = search_songs(
+        song_query(song.title, song.artist, song.album.title), session
+    )
+
+    if not len(search_results):
+        raise RuntimeError(
+            f"song not found on YouTube Music: {song.title} - {song.album} - {song.artist}"
+        )
+
+    if threshold is not None:
+        return auto_match(song, search_results, session, threshold, duration)
+
+    typer.echo("Youtube Music search results found, choose one:")
+    return song_from_result(song, choose_result(search_results))
@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+
+from mutagen import MutagenError
+from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
+
+from amusing.core.artwork import ARTWORK_FILTER, artwork_key, normalize_artwork
+from amusing.db.models import Song
+
+# MP4 atoms of the text tags, named as the FFmpeg metadata keys
+MP4_TEXT_ATOMS = {
+    "title": "\xa9nam",
+    "album": "\xa9alb",
+    "artist": "\xa9ART",
+    "composer": "\xa9wrt",
+    "genre": "\xa9gen",
+    "album_artist": "aART",
+    "date": "\xa9day",
+}
+# Freeform MP4 atom of the fingerprint of the tags a song file was generated with
+FINGERPRINT_ATOM = "----:com.github.amusing:fingerprint"
+# ioctl sharing the data of a file with another until either is written (Linux)
+FICLONE = 0x40049409
+
+
+def song_tags(song: Song) -> dict:
+    """Return the tags of a song file, None for the unknown ones."""
+    album = song.album
+    return {
+        "title": song.title,
+        "album": album.title,
+        "artist": song.artist,
+        "composer": song.composer,
+        "genre": song.genre,
+        "disc": song.disc,
+        "track": song.track,
+        "tracks": album.tracks,
+        "album_artist": album.artist,
+        "date": album.release_date,
+    }
+
+
+def tag_fingerprint(song: Song) -> str:
+    """
+    Return the fingerprint of the tags and artwork of a song file, which only
+    changes when the song file would be tagged differently.
+    """
+    tags = {**song_tags(song), "artwork_hash": artwork_key(song.album.artwork_url)}
+    return hashlib.md5(json.dumps(tags, sort_keys=True).encode()).hexdigest()
+
+
+def read_fingerprint(file_path: str) -> str:
+    """Return the fingerprint embedded in a song file, None if unknown."""
+    try:
+        values = MP4(file_path).tags.get(FINGERPRINT_ATOM)
+    except (MutagenError, AttributeError):
+        return None
+    return bytes(values[0]).decode() if values else None
+
+
+def tag_mp4(
+    file_path: str,
+    tags: dict,
+    artwork: bytes = None,
+    fingerprint: str = None,
+    convert_embedded: bool = True,
+):
+    """
+    Write the tags and artwork of an MP4 file in place, without rewriting its audio.
+    The artwork, already converted, defaults to the one embedded, e.g. the video
+    thumbnail, which is converted if convert_embedded.
+
+    Raises: MutagenError if the file is not a valid MP4 file
+    """
+    mp4 = MP4(file_path)
+    if mp4.tags is None:
+        mp4.add_tags()
+    for key, atom in MP4_TEXT_ATOMS.items():
+        if tags[key] is not None:
+            mp4.tags[atom] = [str(tags[key])]
+        else:
+            mp4.tags.pop(atom, None)
+    if tags["disc"] is not None:
+        mp4.tags["disk"] = [(int(tags["disc"]), 0)]
+    else:
+        mp4.tags.pop("disk", None)
+    if tags["track"] is not None:
+        mp4.tags["trkn"] = [(int(tags["track"]), int(tags["tracks"] or 0))]
+    else:
+        mp4.tags.pop("trkn", None)
+    if fingerprint:
+        mp4.tags[FINGERPRINT_ATOM] = [MP4FreeForm(fingerprint.encode())]
+
+    if artwork is None and convert_embedded and mp4.tags.get("covr"):
+        artwork = normalize_artwork(bytes(mp4.tags["covr"][0]))
+    if artwork:
+        mp4.tags["covr"] = [MP4Cover(artwork, imageformat=MP4Cover.FORMAT_PNG)]
+    mp4.save()
+
+
+def ffmpeg_tag(input_file: str, output_file: str, tags: dict, artwork: bytes = None):
+    """Remux a song file with its tags and artwork, read from stdin, through FFmpeg."""
+    args = [
+        "ffmpeg",
+        "-y",
+        "-i",
+        input_file,
+        "-metadata",
+        f"title={tags['title']}",
+        "-metadata",
+        f"album={tags['album']}",
+        "-metadata",
+        f"artist={tags['artist']}",
+        "-metadata",
+        f"composer={tags['composer']}",
+        "-metadata",
+        f"genre={tags['genre']}",
+        "-metadata",
+        f"disc={tags['disc']}",
+        "-metadata",
+        f"track={tags['track']}/{tags['tracks']}",
+        "-metadata",
+        f"album_artist={tags['album_artist']}",
+        "-metadata",
+        f"date={tags['date']}",
+        "-acodec",
+        "copy",
+        "-vcodec",
+        "png",
+        "-disposition:v",
+        "attached_pic",
+        "-vf",
+        ARTWORK_FILTER,
+        output_file,
+    ]
+
+    if artwork:
+        # Add artwork input to arguments
+        args.insert(4, "-i")
+        args.insert(5, "pipe:0")
+
+    result = subprocess.run(
+        args,
+        input=artwork,
+        capture_output=True,
+    )
+    rc = result.returncode
+    if rc:
+        print(result.stderr.decode(errors="replace"))
+        print(f"[!] FFmpeg exited with error code {rc}")
+
+
+def clone_file(source: str, destination: str):
+    """
+    Copy a file, as a reflink sharing its data where the file system allows it
+    (Btrfs, XFS), so that writing either file never changes the other.
+    """
+    try:
+        import fcntl
+
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except (ImportError, OSError):
+        shutil.copyfile(source, destination)
+
+
+def tag_song_file(
+    input_file: str,
+    output_file: str,
+    song: Song,
+    artwork: bytes = None,
+    fingerprint: str = None,
+):
+    """
+    Generate a song file with its tags and converted artwork from the downloaded
+    audio, and the fingerprint of its tags.
+
+    The downloaded audio is copied, as a reflink where possible, and the copy
+    tagged in place with mutagen, then renamed to the song file: the download
+    is never modified, and a partially tagged song file is never used. FFmpeg
+    remuxes it only if it is not a valid MP4 file.
+    """
+    tags = song_tags(song)
+    temp_file = f"{output_file}.part"
+    if os.path.exists(temp_file):
+        # Left by an interrupted run, possibly linked to the download
+        os.remove(temp_file)
+    clone_file(input_file, temp_file)
+    try:
+        tag_mp4(temp_file, tags, artwork, fingerprint)
+    except MutagenError as e:
+        os.remove(temp_file)
+        print(f"[!] Could not tag '{input_file}' in place ({e}), remuxing with FFmpeg")
+        ffmpeg_tag(input_file, output_file, tags, artwork)
+        return
+    except BaseException:
+        os.remove(temp_file)
+        raise
+    os.replace(temp_file, output_file)
+
+
+def retag_song_file(
+    file_path: str, song: Song, artwork: bytes = None, fingerprint: str = None
+):
+    """
+    Update the tags of a generated song file in place, keeping its artwork if no
+    other is given.
+
+    Raises: RuntimeError if the file cannot be tagged
+    """
+    try:
+        tag_mp4(file_path, song_tags(song), artwork, fingerprint, False)
+    except MutagenError as e:
+        raise RuntimeError(f"failed to update the tags of '{file_path}': {e}")
@@ -0,0 +1,56 @@
+from ytmusicapi import YTMusic
+
+from amusing.core.http import RateLimiter, Shared, new_session
+
+# Number of connections kept alive to YouTube Music
+DEFAULT_POOL_SIZE = 10
+# Maximum number of requests sent to YouTube Music per second
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+# Retries of a throttled or failed request
+DEFAULT_RETRIES = 5
+
+
+class YTMusicClient:
+    """
+    A YouTube Music client shared by the whole process.
+
+    Requests go through a single pooled HTTP session and are rate limited, the
+    throttled ones are retried.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+        retries: int = DEFAULT_RETRIES,
+    ):
+        self.pool_size = pool_size
+        self.ytmusic = YTMusic(
+            # YouTube Music searches are POST requests, that are safe to retry
+            requests_session=new_session(pool_size, retries, retry_all_methods=True)
+        )
+        self.limiter = RateLimiter(requests_per_second)
+
+    def search(self, query: str, **kwargs) -> list:
+        self.limiter.wait()
+        return self.ytmusic.search(query, **kwargs)
+
+    def get_song(self, video_id: str) -> dict:
+        self.limiter.wait()
+        return self.ytmusic.get_song(video_id)
+
+
+_client = Shared(YTMusicClient)
+
+
+def configure_ytmusic_client(**settings):
+    """
+    Set the pool size, requests_per_second or retries of the shared YouTube
+    Music client, before it is first used.
+    """
+    _client.configure(**settings)
+
+
+def get_ytmusic_client() -> YTMusicClient:
+    """Return the YouTube Music client shared by the whole process."""
+    return _client.get()
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import Session
 
 from .models import Base
@@ -8,6 +8,17 @@ def get_new_db_session(name: str = "./library.db") -> Session:
     """Create db and table and return a new session."""
     DATABASE_URL = f"sqlite:///{name}"
     engine = create_engine(DATABASE_URL, pool_size=20)
+
+    # Let SQLAlchemy handle transactions instead of pysqlite, which is required
+    # for savepoints to work as expected with SQLite
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
     Base.metadata.create_all(bind=engine)
 
     session = Session(bind=engine)
@@ -56,6 +56,9 @@ class Song(Base):
     video_id: Mapped[str] = mapped_column(nullable=False)
     album_id: Mapped[int] = mapped_column(ForeignKey("albums.id"), nullable=False)
     album: Mapped["Album"] = relationship(back_populates="songs")
+    file: Mapped["SongFile"] = relationship(
+        back_populates="song", cascade="all, delete-orphan"
+    )
 
     def __repr__(self):
         return f"<Song= {self.title} by {self.artist}>"
@@ -68,6 +71,8 @@ class Song(Base):
         # Get rid of SQLAlchemy special attr
         d.pop("_sa_instance_state")
         d["album"] = self.album.clone()
+        if "file" in d:
+            d.pop("file")
         copy = self.__class__(**d)
         return copy
 
@@ -86,3 +91,67 @@ class Organizer(Base):
 
     def __repr__(self):
         return f"<Organized Song= {self.id} with org video id {self.org_video_id}"
+
+
+class SearchCache(Base):
+    """
+    The SearchCache model keeps the YouTube Music results of a search query, so that
+    the same search is not sent again. A row expires after a while and the least
+    recently used rows are dropped when the cache is full.
+    """
+
+    __tablename__ = "search_cache"
+
+    query: Mapped[str] = mapped_column(primary_key=True)
+    results: Mapped[str] = mapped_column(nullable=False)
+    created_at: Mapped[float] = mapped_column(nullable=False)
+    accessed_at: Mapped[float] = mapped_column(nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<Search Cache= {self.query}>"
+
+
+class ReviewItem(Base):
+    """
+    The ReviewItem model queues a song that could not be matched with confidence to
+    a YouTube Music result, along with the results found, until a video ID is chosen.
+    """
+
+    __tablename__ = "review_queue"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    title: Mapped[str] = mapped_column(nullable=False)
+    artist: Mapped[str] = mapped_column(nullable=False)
+    album: Mapped[str] = mapped_column(nullable=False)
+    candidates: Mapped[str] = mapped_column(nullable=False)
+    score: Mapped[float] = mapped_column(nullable=False)
+    video_id: Mapped[str] = mapped_column(nullable=True)
+
+    def __repr__(self):
+        return f"<Review Item= {self.title} by {self.artist}>"
+
+
+class SongFile(Base):
+    """
+    The SongFile model keeps an inventory of the generated song files. A row of this table
+    describes the file of a song as it was generated, so that whether it is up to date can
+    be told without looking at the file system.
+    """
+
+    __tablename__ = "song_files"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    song_id: Mapped[int] = mapped_column(
+        ForeignKey("songs.id"), nullable=False, unique=True
+    )
+    path: Mapped[str] = mapped_column(nullable=False)
+    size: Mapped[int] = mapped_column(nullable=False)
+    mtime: Mapped[float] = mapped_column(nullable=False)
+    artwork_hash: Mapped[str] = mapped_column(nullable=False)
+    video_id: Mapped[str] = mapped_column(nullable=False)
+    # Fingerprint of the tags the file was generated with
+    fingerprint: Mapped[str] = mapped_column(nullable=True)
+    song: Mapped["Song"] = relationship(back_populates="file")
+
+    def __repr__(self):
+        return f"<Song File= {self.path}>"
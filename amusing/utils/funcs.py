@@ -1,3 +1,4 @@
+import json
 import os
 
 from .config import APP_CONFIG
@@ -13,6 +14,14 @@ def construct_download_path(root_path: str, dir_name: str = "downloads") -> str:
     return os.path.join(root_path, dir_name)
 
 
+def save_json_atomic(path: str, data):
+    """Write data as JSON to path, a reader never sees a partially written file."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(data, file)
+    os.replace(temp_path, path)
+
+
 # Escape reserved system special characters with unicode variants
 # Based on Windows (more restrictive) reserved characters: https://learn.microsoft.com/en-us/windows/win32/fileio/naming-a-file#naming-conventions
 def escape(name: str) -> str:
@@ -0,0 +1,165 @@
+"""
+Compare the bytes written per song to download and tag it, as before (the video
+thumbnail embedded by yt-dlp, then the song file copied and tagged) and in a
+single tagging pass (the thumbnail embedded with the tags, in a copy of the
+downloaded audio). The copy alone is measured too: it is a reflink, written
+once with the audio, only on file systems supporting them (Btrfs, XFS).
+
+A stub extractor serves a 3 minutes song and a thumbnail from a local HTTP
+server, run in another process so that only the writes of the download and
+tagging are counted, from /proc/self/io (Linux only). FFmpeg is required.
+
+    python benchmarks/single_pass_tagging.py [number of songs]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yt_dlp
+from yt_dlp.extractor.common import InfoExtractor
+
+from amusing.core.download import SongDownloader, album_artwork
+from amusing.core.tagging import (
+    clone_file,
+    song_tags,
+    tag_fingerprint,
+    tag_mp4,
+    tag_song_file,
+)
+from amusing.db.models import Album, Song
+
+# Options of the downloads before, the second "postprocessors" key of the
+# options dict left out FFmpegExtractAudio
+PREVIOUS_OPTIONS = {
+    "format": "m4a/bestaudio/best",
+    "outtmpl": {"pl_thumbnail": ""},
+    "postprocessors": [{"already_have_thumbnail": False, "key": "EmbedThumbnail"}],
+    "writethumbnail": True,
+}
+QUIET_OPTIONS = {"quiet": True, "noprogress": True}
+
+
+class StubIE(InfoExtractor):
+    _VALID_URL = r"stub:(?P<id>\w+)"
+    server_url = ""
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        return {
+            "id": video_id,
+            "title": f"Song {video_id}",
+            "url": f"{self.server_url}/song.m4a",
+            "ext": "m4a",
+            "thumbnails": [{"id": "0", "url": f"{self.server_url}/thumbnail.jpg"}],
+        }
+
+
+def written_bytes() -> int:
+    with open("/proc/self/io", "r") as io:
+        return next(int(line.split()[1]) for line in io if line.startswith("wchar:"))
+
+
+def make_fixtures(path: str):
+    """A song without faststart, as remuxed by yt-dlp, and a 720p thumbnail."""
+    for args in [
+        ["-f", "lavfi", "-i", "sine=d=180", "-c:a", "aac", "-b:a", "128k"],
+        ["-f", "lavfi", "-i", "testsrc=s=1280x720", "-frames:v", "1"],
+    ]:
+        name = "song.m4a" if "aac" in args else "thumbnail.jpg"
+        subprocess.run(
+            ["ffmpeg", "-loglevel", "error", "-y", *args, os.path.join(path, name)],
+            check=True,
+        )
+
+
+def two_passes(song: Song, url: str, path: str, output_file: str):
+    """Previous behaviour: the thumbnail is embedded, then the file copied and tagged."""
+    with yt_dlp.YoutubeDL(
+        {**PREVIOUS_OPTIONS, **QUIET_OPTIONS, "paths": {"home": path}}
+    ) as ydl:
+        ydl.add_info_extractor(StubIE())
+        info = ydl.extract_info(url, download=True, ie_key="Stub")
+    downloaded_file = info["requested_downloads"][0]["filepath"]
+    shutil.copyfile(downloaded_file, output_file)
+    tag_mp4(output_file, song_tags(song), None, tag_fingerprint(song))
+
+
+def single_pass(
+    downloader: SongDownloader, song: Song, url: str, path: str, output_file: str
+):
+    """The thumbnail is embedded with the tags, in a copy of the downloaded audio."""
+    downloaded_file, thumbnail = downloader.download(
+        url, path, ie_key="Stub", thumbnail=True
+    )
+    artwork = album_artwork(song, thumbnail)
+    tag_song_file(downloaded_file, output_file, song, artwork, tag_fingerprint(song))
+    os.remove(thumbnail)
+
+
+def copy_only(source: str, url: str, path: str, output_file: str):
+    """The copy of the downloaded audio made by the single pass."""
+    clone_file(source, output_file)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    song = Song(
+        title="Song",
+        artist="Artist",
+        genre="Genre",
+        disc=1,
+        track=1,
+        album=Album(title="Album", artist="Artist", tracks=10, release_date="2024"),
+    )
+    with tempfile.TemporaryDirectory() as fixtures:
+        make_fixtures(fixtures)
+        song_file = os.path.join(fixtures, "song.m4a")
+        audio_size = os.path.getsize(song_file)
+        server = subprocess.Popen(
+            [sys.executable, "-u", "-m", "http.server", "0", "--bind", "127.0.0.1"],
+            cwd=fixtures,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        try:
+            # "Serving HTTP on 127.0.0.1 port 12345 (http://127.0.0.1:12345/) ..."
+            port = server.stdout.readline().split(" port ")[1].split()[0]
+            StubIE.server_url = f"http://127.0.0.1:{port}"
+            downloader = SongDownloader(QUIET_OPTIONS)
+            downloader.ydl.add_info_extractor(StubIE())
+            print(f"{'audio':>12}: {audio_size / 1e6:6.2f} MB per song")
+            for name, run in [
+                ("two passes", lambda *args: two_passes(song, *args)),
+                ("single pass", lambda *args: single_pass(downloader, song, *args)),
+                ("copy only", lambda *args: copy_only(song_file, *args)),
+            ]:
+                with tempfile.TemporaryDirectory() as path:
+                    start_bytes = written_bytes()
+                    start = time.perf_counter()
+                    for index in range(count):
+                        song_dir = os.path.join(path, str(index))
+                        os.makedirs(song_dir)
+                        run(
+                            f"stub:song{index}",
+                            song_dir,
+                            os.path.join(song_dir, "Song [artwork] [video].m4a"),
+                        )
+                    elapsed = time.perf_counter() - start
+                    written = (written_bytes() - start_bytes) / count
+                print(
+                    f"{name:>12}: {written / 1e6:6.2f} MB written per song "
+                    f"({written / audio_size:.2f}x the audio), "
+                    f"{1000 * elapsed / count:6.1f} ms per song"
+                )
+            downloader.close()
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
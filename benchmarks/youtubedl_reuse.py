@@ -0,0 +1,99 @@
+"""
+Compare the cost of downloading songs with a new YoutubeDL per song, as before,
+and with a long-lived SongDownloader.
+
+A stub extractor serves tiny files from a local HTTP server, so that only the
+setup and bookkeeping costs of yt-dlp are measured, without YouTube.
+
+    python benchmarks/youtubedl_reuse.py [number of songs]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yt_dlp
+from yt_dlp.extractor.common import InfoExtractor
+
+from amusing.core.download import YDL_OPTIONS, SongDownloader
+
+AUDIO = b"\0" * 1024
+# No thumbnail nor FFmpeg post-processing, which are the same in both cases
+BENCHMARK_OPTIONS = {
+    "postprocessors": [],
+    "writethumbnail": False,
+    "quiet": True,
+    "noprogress": True,
+}
+
+
+class AudioHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mp4")
+        self.send_header("Content-Length", str(len(AUDIO)))
+        self.end_headers()
+        self.wfile.write(AUDIO)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubIE(InfoExtractor):
+    _VALID_URL = r"stub:(?P<id>\w+)"
+    server_url = ""
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        return {
+            "id": video_id,
+            "title": f"Song {video_id}",
+            "url": f"{self.server_url}/{video_id}.m4a",
+            "ext": "m4a",
+        }
+
+
+def per_song_downloader(urls: list, path: str):
+    """Previous behaviour: a YoutubeDL is set up for every song."""
+    for url in urls:
+        options = {**YDL_OPTIONS, **BENCHMARK_OPTIONS, "paths": {"home": path}}
+        with yt_dlp.YoutubeDL(options) as ydl:
+            ydl.add_info_extractor(StubIE())
+            ydl.extract_info(url, download=True, ie_key="Stub")
+
+
+def long_lived_downloader(urls: list, path: str):
+    """A single downloader serves every song."""
+    downloader = SongDownloader(BENCHMARK_OPTIONS)
+    downloader.ydl.add_info_extractor(StubIE())
+    for url in urls:
+        downloader.download(url, path, ie_key="Stub")
+    downloader.close()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    server = ThreadingHTTPServer(("127.0.0.1", 0), AudioHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    StubIE.server_url = f"http://127.0.0.1:{server.server_port}"
+
+    for name, run in [
+        ("new YoutubeDL per song", per_song_downloader),
+        ("long-lived downloader", long_lived_downloader),
+    ]:
+        with tempfile.TemporaryDirectory() as path:
+            urls = [f"stub:song{index}" for index in range(count)]
+            start = time.perf_counter()
+            run(urls, path)
+            elapsed = time.perf_counter() - start
+            assert len(os.listdir(path)) == count
+        print(
+            f"{name:>24}: {elapsed:6.2f}s for {count} songs, {1000 * elapsed / count:6.1f} ms per song"
+        )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+from amusing.core import musicbrainz_index
+from amusing.core.musicbrainz_client import COVER_ART_ARCHIVE_URL
+from amusing.core.musicbrainz_index import MusicBrainzIndex, build_index
+
+# Four releases, the last one listing release-3 again with another title
+DUMP_PATH = os.path.join(
+    os.path.dirname(__file__), "fixtures", "musicbrainz_releases.jsonl"
+)
+
+
+@pytest.fixture(params=[1, 1000], ids=["batch-per-release", "single-batch"])
+def index(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(musicbrainz_index, "IMPORT_BATCH_SIZE", request.param)
+    index_path = str(tmp_path / "musicbrainz.db")
+    assert build_index(DUMP_PATH, index_path) == 3
+    assert not os.path.exists(f"{index_path}.tmp")
+    return MusicBrainzIndex(index_path)
+
+
+def test_search_releases(index):
+    releases = index.search_releases("Blue Horizons", "The Wanderers")
+    assert [release["id"] for release in releases] == ["release-1"]
+    assert releases[0]["media"][0]["tracks"][1]["title"] == "Harbour Lights"
+
+
+def test_search_releases_folds_diacritics(index):
+    releases = index.search_releases("Cafe Sessions", "Zoe Quartet")
+    assert [release["id"] for release in releases] == ["release-2"]
+
+
+def test_release_listed_twice_is_indexed_once(index):
+    releases = index.search_releases("Northern Roads")
+    assert [release["id"] for release in releases] == ["release-3"]
+    releases = index.search_releases(None, "The Wanderers")
+    assert sorted(release["id"] for release in releases) == ["release-1", "release-3"]
+    assert index.search_releases("Old Title") == []
+    assert index.search_recordings("Lost Song") == []
+
+
+def test_search_recordings(index):
+    recordings = index.search_recordings("Harbour Lights")
+    assert sorted(recording["id"] for recording in recordings) == [
+        "release-1-rec2",
+        "release-2-rec2",
+    ]
+
+    (recording,) = index.search_recordings(
+        "Harbour Lights", "The Wanderers", "Blue Horizons"
+    )
+    assert recording["title"] == "Harbour Lights"
+    assert recording["artist-credit"][0]["name"] == "The Wanderers"
+    (release,) = recording["releases"]
+    assert release["id"] == "release-1"
+    assert release["date"] == "2001"
+    assert release["media"][0]["position"] == 1
+    assert release["media"][0]["track"][0]["position"] == 2
+
+
+def test_artwork_url(index):
+    assert (
+        index.artwork_url("release-1")
+        == f"{COVER_ART_ARCHIVE_URL}/release/release-1/front-1200"
+    )
+    assert index.artwork_url("release-2") is None
+    assert index.artwork_url("unknown") is None